@@ -0,0 +1,174 @@
+"""
+Admission.py file for ProxyGPT. This file contains the admission controller
+that bounds the number of OpenAI calls in flight in a worker.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for waiting in the queue
+import asyncio
+from collections import deque
+import math
+import time
+
+from typing import Optional
+
+
+# ------------- [Classes] -------------
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed because it can not be served within its deadline.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """
+    A slot held by an admitted request. Releasing it more than once has no effect.
+    """
+
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller._release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionController:
+    """
+    Lets at most max_inflight requests of a worker call OpenAI at once. Other
+    requests wait in a FIFO queue of at most max_queue entries.
+
+    A request is shed at once if the queue is full, or if the expected wait
+    (from its queue position and the average time a slot is held) is longer
+    than its deadline. A request that is still queued at its deadline is shed
+    as well. Shed requests get a Retry-After hint in seconds.
+
+    Background work (batches) waits in a separate queue without a limit or
+    deadline, and is only admitted when no interactive request is waiting.
+    It does not count toward the queue position of interactive requests.
+    """
+
+    # Weight of the newest sample in the moving average of the slot hold time
+    SERVICE_TIME_WEIGHT = 0.1
+
+    def __init__(self, max_inflight: int, max_queue: int, deadline: float):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.inflight = 0
+        self.average_service_time = 0.0
+        self._waiters = deque()
+        self._background_waiters = deque()
+        self.counters = {
+            "admitted": 0,
+            "queued": 0,
+            "shed_queue_full": 0,
+            "shed_expected_wait": 0,
+            "shed_deadline": 0,
+        }
+        self.waited = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def expected_wait(self, position: int) -> float:
+        """
+        Returns the expected wait in seconds of a request at position in the queue.
+        """
+        return (position + 1) * self.average_service_time / self.max_inflight
+
+    def _shed(self, counter: str, reason: str, position: int) -> AdmissionRejected:
+        self.counters[counter] += 1
+        return AdmissionRejected(reason, max(1, math.ceil(self.expected_wait(position))))
+
+    async def acquire(self, background: bool = False) -> AdmissionTicket:
+        """
+        Waits for a slot and returns its ticket.
+
+        Args:
+            background (bool): Set to True for background work such as batches,
+                which waits without a deadline and without the queue limit.
+
+        Raises:
+            AdmissionRejected: If the request is shed.
+        """
+        deadline = None if background else self.deadline
+
+        if self.inflight < self.max_inflight and not self._waiters and not self._background_waiters:
+            self.inflight += 1
+            self.counters["admitted"] += 1
+            return AdmissionTicket(self)
+
+        waiters = self._background_waiters if background else self._waiters
+        position = len(waiters)
+        if deadline is not None:
+            if position >= self.max_queue:
+                raise self._shed("shed_queue_full", "Admission queue is full.", position)
+            if self.expected_wait(position) > deadline:
+                raise self._shed("shed_expected_wait", "Request can not be served within its deadline.", position)
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        self.counters["queued"] += 1
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), deadline)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiters.remove(waiter)
+                raise self._shed("shed_deadline", "Request can not be served within its deadline.", len(self._waiters))
+        except asyncio.CancelledError:
+            if waiter.done():
+                # The slot was handed over just as the request was cancelled, so pass it on
+                self._release(None)
+            else:
+                waiters.remove(waiter)
+            raise
+
+        wait_time = time.monotonic() - queued_at
+        self.waited += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.counters["admitted"] += 1
+        return AdmissionTicket(self)
+
+    def _release(self, service_time: Optional[float]) -> None:
+        if service_time is not None:
+            self.average_service_time += self.SERVICE_TIME_WEIGHT * (service_time - self.average_service_time)
+        # Hand the slot straight to the next waiter, so inflight stays the same.
+        # Interactive requests go first, background work only gets idle slots.
+        for waiters in (self._waiters, self._background_waiters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.inflight -= 1
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth, wait times and shed counts of the controller.
+        """
+        stats = dict(self.counters)
+        stats["shed"] = stats["shed_queue_full"] + stats["shed_expected_wait"] + stats["shed_deadline"]
+        stats["inflight"] = self.inflight
+        stats["max_inflight"] = self.max_inflight
+        stats["queue_depth"] = len(self._waiters)
+        stats["background_queue_depth"] = len(self._background_waiters)
+        stats["max_queue"] = self.max_queue
+        stats["average_wait_time"] = self.total_wait_time / self.waited if self.waited else 0.0
+        stats["max_wait_time"] = self.max_wait_time
+        stats["average_service_time"] = self.average_service_time
+        return stats
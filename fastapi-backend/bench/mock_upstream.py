@@ -0,0 +1,144 @@
+"""
+Mock_upstream.py file for ProxyGPT. This file contains a local mock of the
+OpenAI chat completions API, used by the benchmark suite.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the mock HTTP server
+import asyncio
+from aiohttp import web
+
+# Required for generating responses
+import json
+import random
+import time
+import uuid
+
+
+# ------------- [Classes] -------------
+
+class MockUpstreamConfig:
+    """
+    Behavior of the mock upstream.
+
+    Args:
+        ttft_ms (float): Median time to the first token in milliseconds.
+        ttft_sigma (float): Spread of the log-normal time to first token distribution.
+        token_rate (float): Completion tokens generated per second after the first token.
+        completion_tokens (int): Completion tokens per response.
+        error_rate (float): Fraction of requests answered with status code 500.
+        throttle_rate (float): Fraction of requests answered with status code 429.
+        seed (int): Seed of the random generator, for repeatable runs.
+    """
+
+    def __init__(self, ttft_ms: float = 800, ttft_sigma: float = 0.3, token_rate: float = 40,
+                 completion_tokens: int = 300, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 seed: int = 0):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class MockUpstream:
+    """
+    aiohttp application answering POST /v1/chat/completions like OpenAI,
+    with and without streaming, in the JSON format of the coaching prompt.
+    """
+
+    def __init__(self, config: MockUpstreamConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+
+    def _ttft(self) -> float:
+        return self.config.ttft_ms / 1000 * self.random.lognormvariate(0, self.config.ttft_sigma)
+
+    def _content_tokens(self) -> list:
+        # Roughly one token per word of the coaching JSON
+        words = ["word"] * max(self.config.completion_tokens - 20, 1)
+        skill = {"skill-brief-title": "Mock skill", "skill-application": " ".join(words[: len(words) // 2])}
+        content = json.dumps({
+            "response_to_user": " ".join(words[len(words) // 2:]),
+            "skill-specific-responses": [skill, skill],
+        })
+        return [content[i:i + 4] for i in range(0, len(content), 4)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        roll = self.random.random()
+        if roll < self.config.error_rate:
+            return web.json_response({"error": {"message": "Mock upstream error", "type": "server_error"}}, status=500)
+        if roll < self.config.error_rate + self.config.throttle_rate:
+            return web.json_response({"error": {"message": "Mock rate limit", "type": "requests"}}, status=429,
+                                     headers={"Retry-After": "1"})
+
+        await asyncio.sleep(self._ttft())
+        pieces = self._content_tokens()
+        prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.config.completion_tokens / self.config.token_rate)
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": self.config.completion_tokens,
+                          "total_tokens": prompt_tokens + self.config.completion_tokens},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        delay = self.config.completion_tokens / self.config.token_rate / len(pieces)
+        for piece in pieces:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(delay)
+        # Like OpenAI, the last chunk has an empty delta and the finish reason
+        chunk["choices"] = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+# ------------- [Functions] -------------
+
+# Make function for starting the mock upstream
+async def start_mock_upstream(config: MockUpstreamConfig, host: str = "127.0.0.1", port: int = 0):
+    """
+    This function starts the mock upstream on the running event loop.
+
+    Returns:
+        tuple: The mock, its aiohttp runner (to clean up) and the base URL to use as OPENAI_API_BASE.
+    """
+    mock = MockUpstream(config)
+    runner = web.AppRunner(mock.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return mock, runner, f"http://{host}:{port}/v1"
@@ -0,0 +1,378 @@
+"""
+Run_bench.py file for ProxyGPT. This file contains the offline load test and
+benchmark suite. It starts the backend against a local mock of the OpenAI
+API, drives the endpoints at a configurable concurrency and writes the
+results as JSON, so runs can be compared across changes.
+
+Usage (from the fastapi-backend directory):
+
+    python bench/run_bench.py --scenarios coach,stream,ratelimit --concurrency 64 --requests 2000 --output bench.json
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the command line interface
+import argparse
+import json
+import os
+import sys
+
+# Required for running the server, the mock and the load
+import asyncio
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+# Required for sending requests
+import aiohttp
+
+# Required for pre-populating the usage tables
+import random
+import sqlite3
+
+from typing import Optional
+
+from mock_upstream import MockUpstreamConfig, start_mock_upstream
+
+
+# ------------- [Settings] -------------
+
+# Directory of the backend, which holds main.py
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# API key of the benchmarked backend
+BENCH_API_KEY = "bench-api-key"
+
+# Interval of the event loop lag probe in seconds
+LAG_PROBE_INTERVAL = 0.01
+
+
+# ------------- [Functions] -------------
+
+# Make function for finding a free local port
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Make function for computing a percentile
+def percentile(values: list, fraction: float) -> float:
+    """
+    This function returns the nearest-rank percentile of values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+# Make function for summarizing latencies in milliseconds
+def summarize(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 0.50), 3),
+        "p95": round(percentile(values, 0.95), 3),
+        "p99": round(percentile(values, 0.99), 3),
+        "max": round(max(values), 3),
+    }
+
+# Make function for pre-populating the usage tables
+def prepopulate_usage(path: str, rows: int) -> None:
+    """
+    This function fills the database of the rate limiter with rows calls
+    spread over the last day, aggregated in its per-minute buckets.
+    """
+    now = int(time.time())
+    timestamps = [now - random.randint(0, 86399) for _ in range(rows)]
+    buckets = {}
+    for timestamp in timestamps:
+        buckets[timestamp // 60] = buckets.get(timestamp // 60, 0) + 1
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS api_usage_buckets (bucket integer PRIMARY KEY, calls integer NOT NULL)")
+        conn.executemany('''INSERT INTO api_usage_buckets (bucket, calls) VALUES (?, ?)
+                            ON CONFLICT(bucket) DO UPDATE SET calls = calls + excluded.calls''', buckets.items())
+
+# Make function for running coroutines on a loop in a background thread
+def start_loop_thread() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+# ------------- [Classes] -------------
+
+class LagMonitor:
+    """
+    Measures how late the event loop of the server runs a callback that is
+    scheduled every LAG_PROBE_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.running = True
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.running:
+            expected = loop.time() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self.samples.append(max(0.0, loop.time() - expected) * 1000)
+
+    def reset(self) -> list:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class InProcessServer:
+    """
+    Runs the backend with uvicorn on a loop in a background thread of this
+    process, together with the event loop lag probe.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.lag_monitor = LagMonitor()
+        self.loop = start_loop_thread()
+
+    def start(self) -> None:
+        import uvicorn
+        sys.path.insert(0, BACKEND_DIR)
+        import main
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=self.port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(config)
+        asyncio.run_coroutine_threadsafe(self.server.serve(), self.loop)
+        asyncio.run_coroutine_threadsafe(self.lag_monitor.run(), self.loop)
+
+    def exit_code(self) -> Optional[int]:
+        # Errors of the server are raised on import, before it starts
+        return None
+
+    def stop(self) -> None:
+        self.lag_monitor.running = False
+        self.server.should_exit = True
+        time.sleep(0.5)
+
+
+class GunicornServer:
+    """
+    Runs the backend with gunicorn and uvicorn workers in a subprocess, like
+    the entrypoint scripts. The event loop lag of the workers is not measured.
+    """
+
+    def __init__(self, port: int, workers: int):
+        self.port = port
+        self.workers = workers
+        self.lag_monitor = None
+
+    def start(self) -> None:
+        self.process = subprocess.Popen([
+            sys.executable, "-m", "gunicorn", "-w", str(self.workers), "-k", "uvicorn.workers.UvicornWorker",
+            "-c", os.path.join(BACKEND_DIR, "gunicorn.conf.py"), "--pythonpath", BACKEND_DIR,
+            "-b", f"127.0.0.1:{self.port}", "--log-level", "warning", "main:app",
+        ], stdout=subprocess.DEVNULL)
+
+    def exit_code(self) -> Optional[int]:
+        # Gunicorn exits early if the workers fail to boot
+        return self.process.poll()
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+class LoadGenerator:
+    """
+    Sends requests of one scenario from concurrency closed-loop clients and
+    records the latency, time to first byte and status of each. Messages are
+    prefixed with the name of the scenario, so a scenario is never answered
+    from the completion cache filled by an earlier one.
+    """
+
+    def __init__(self, base_url: str, scenario: str, concurrency: int, requests: int, repeat_ratio: float, seed: int):
+        self.base_url = base_url
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.requests = requests
+        self.repeat_ratio = repeat_ratio
+        self.random = random.Random(seed)
+        self.headers = {"Authorization": f"Bearer {BENCH_API_KEY}"}
+        self.sequence = 0
+
+    def next_message(self) -> str:
+        # Repeated messages exercise the completion cache and request coalescing
+        self.sequence += 1
+        if self.random.random() < self.repeat_ratio:
+            return f"[{self.scenario}] I keep putting off my goals and want to find people to support my dream ({self.random.randint(0, 9)})"
+        return f"[{self.scenario}] Benchmark situation {self.sequence}-{self.random.random()}: I feel stuck at work and want to grow."
+
+    async def send(self, session: aiohttp.ClientSession) -> tuple:
+        start = time.perf_counter()
+        ttfb = None
+        if self.scenario == "ratelimit":
+            request = session.get(f"{self.base_url}/ratelimit", headers=self.headers)
+        elif self.scenario == "stream":
+            request = session.post(f"{self.base_url}/api/openai/joycoachgpt/stream",
+                                   params={"message": self.next_message()}, headers=self.headers)
+        else:
+            request = session.post(f"{self.base_url}/api/openai/joycoachgpt",
+                                   params={"message": self.next_message()}, headers=self.headers)
+        async with request as response:
+            async for _ in response.content.iter_any():
+                if ttfb is None:
+                    ttfb = (time.perf_counter() - start) * 1000
+        return response.status, (time.perf_counter() - start) * 1000, ttfb
+
+    async def run(self) -> dict:
+        latencies = []
+        ttfbs = []
+        statuses = {}
+        errors = 0
+        remaining = [self.requests]
+
+        async def client(session: aiohttp.ClientSession) -> None:
+            nonlocal errors
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                try:
+                    status, latency, ttfb = await self.send(session)
+                except Exception:
+                    errors += 1
+                    continue
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status == 200:
+                    latencies.append(latency)
+                    if ttfb is not None:
+                        ttfbs.append(ttfb)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=600)
+        start = time.perf_counter()
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[client(session) for _ in range(self.concurrency)])
+        elapsed = time.perf_counter() - start
+
+        return {
+            "requests": self.requests,
+            "concurrency": self.concurrency,
+            "duration_s": round(elapsed, 3),
+            "requests_per_second": round(self.requests / elapsed, 3),
+            "successful_per_second": round(len(latencies) / elapsed, 3),
+            "status_counts": statuses,
+            "client_errors": errors,
+            "latency_ms": summarize(latencies),
+            "ttfb_ms": summarize(ttfbs),
+        }
+
+
+# ------------- [Main] -------------
+
+# Make function for waiting until the server answers
+async def wait_until_ready(base_url: str, server, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            if server.exit_code() is not None:
+                raise RuntimeError(f"The backend exited with code {server.exit_code()} before it was ready.")
+            try:
+                async with session.get(f"{base_url}/ratelimit", headers={"Authorization": f"Bearer {BENCH_API_KEY}"}) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("The backend did not start in time.")
+
+# Make function for parsing the command line arguments
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test and benchmark of the Joycoach backend.")
+    parser.add_argument("--scenarios", default="coach,stream,ratelimit",
+                        help="Comma separated scenarios to run: coach, stream, ratelimit.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients per scenario.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario.")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Fraction of coaching messages drawn from a small repeated pool.")
+    parser.add_argument("--server", choices=["inprocess", "gunicorn"], default="inprocess",
+                        help="Run the backend in this process (measures event loop lag) or with gunicorn.")
+    parser.add_argument("--workers", type=int, default=4, help="Gunicorn workers.")
+    parser.add_argument("--prepopulate-usage", type=int, default=0, help="Calls to pre-populate in the usage tables, spread over the last day.")
+    parser.add_argument("--ttft-ms", type=float, default=800, help="Median time to first token of the mock upstream.")
+    parser.add_argument("--ttft-sigma", type=float, default=0.3, help="Spread of the log-normal time to first token.")
+    parser.add_argument("--token-rate", type=float, default=40, help="Completion tokens per second of the mock upstream.")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="Completion tokens per mock response.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock responses with status code 500.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of mock responses with status code 429.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for repeatable runs.")
+    parser.add_argument("--output", default="bench_results.json", help="File to write the JSON results to.")
+    return parser.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    random.seed(args.seed)
+
+    output = os.path.abspath(args.output)
+
+    # Run in a scratch directory so the databases of the backend start empty
+    workdir = tempfile.mkdtemp(prefix="joycoach-bench-")
+    os.chdir(workdir)
+    if args.prepopulate_usage:
+        prepopulate_usage(os.path.join(workdir, "proxygpt.db"), args.prepopulate_usage)
+
+    # Start the mock upstream on its own loop, so it does not compete with the server or the clients
+    mock_config = MockUpstreamConfig(args.ttft_ms, args.ttft_sigma, args.token_rate, args.completion_tokens,
+                                     args.error_rate, args.throttle_rate, args.seed)
+    mock_loop = start_loop_thread()
+    mock, runner, api_base = asyncio.run_coroutine_threadsafe(start_mock_upstream(mock_config), mock_loop).result()
+
+    # The backend reads its configuration from the environment on import
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_API_BASE": api_base,
+        "PROXYGPT_API_KEY": BENCH_API_KEY,
+        "PROXYGPT_HOURLY_RATE_LIMIT": str(10 ** 9),
+        "PROXYGPT_DAILY_RATE_LIMIT": str(10 ** 9),
+    })
+    os.environ.pop("DISCORD_WEBHOOK", None)
+
+    port = free_port()
+    server = InProcessServer(port) if args.server == "inprocess" else GunicornServer(port, args.workers)
+    server.start()
+    base_url = f"http://127.0.0.1:{port}"
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None,
+        "config": dict(vars(args), mock_upstream=mock_config.to_dict()),
+        "scenarios": {},
+    }
+    try:
+        asyncio.run(wait_until_ready(base_url, server))
+        for index, scenario in enumerate(args.scenarios.split(",")):
+            if server.lag_monitor:
+                server.lag_monitor.reset()
+            upstream_requests = mock.requests
+            # Each scenario gets its own seed and messages, so it does not replay the cached prompts of the one before
+            generator = LoadGenerator(base_url, scenario, args.concurrency, args.requests, args.repeat_ratio, args.seed + index)
+            result = asyncio.run(generator.run())
+            result["upstream_requests"] = mock.requests - upstream_requests
+            result["event_loop_lag_ms"] = summarize(server.lag_monitor.reset()) if server.lag_monitor else None
+            results["scenarios"][scenario] = result
+            print(f"{scenario}: {result['requests_per_second']} req/s, latency {result['latency_ms']}, statuses {result['status_counts']}, upstream requests {result['upstream_requests']}")
+        results["mock_upstream_requests"] = mock.requests
+    finally:
+        server.stop()
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), mock_loop).result()
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Cache.py file for ProxyGPT. This file contains the tiered completion cache
+used to answer repeated coaching situations without calling OpenAI.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the on-disk tier
+import sqlite3
+import threading
+
+# Required for cache keys and expiry
+from collections import OrderedDict
+import hashlib
+import json
+import time
+
+from typing import Optional
+
+
+# ------------- [Settings] -------------
+
+# Seconds between removals of expired and excess entries from the on-disk tier
+PRUNE_INTERVAL = 60
+
+
+# ------------- [Functions] -------------
+
+# Make function for normalizing a user message
+def normalize_message(message: str) -> str:
+    """
+    This function normalizes a message so that messages which only differ in
+    case or whitespace share a cache entry.
+    """
+    return " ".join(message.split()).casefold()
+
+# Make function for building a cache key
+def make_cache_key(message: str, model: str, params: dict) -> str:
+    """
+    This function returns the cache key of a completion, built from the
+    normalized message, the model and the sampling parameters.
+    """
+    key_data = json.dumps([normalize_message(message), model, params], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+# ------------- [Classes] -------------
+
+class CompletionCache:
+    """
+    Two-tier cache for completions.
+
+    The first tier is an in-process LRU with a size cap. The second tier is
+    a SQLite database in WAL mode, which survives restarts and is shared by
+    all gunicorn workers. Entries expire after ttl seconds in both tiers.
+    Every PRUNE_INTERVAL seconds, expired entries are removed from the
+    on-disk tier, and the entries that expire first are evicted if it holds
+    more than max_disk_entries.
+    """
+
+    # Seconds between checks for invalidations made by other workers
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, max_entries: int, ttl: int, path: Optional[str] = None, max_disk_entries: Optional[int] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._last_pruned = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._synced_at = 0.0
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "disk_expirations": 0,
+            "disk_evictions": 0,
+        }
+
+        if self.path:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS completion_cache
+                            (key text PRIMARY KEY, value text NOT NULL, expires_at real NOT NULL)''')
+            # Pruning reads the entries in order of expiry
+            conn.execute("CREATE INDEX IF NOT EXISTS completion_cache_expires_at ON completion_cache (expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS completion_cache_generation (generation integer NOT NULL)")
+            conn.execute('''INSERT INTO completion_cache_generation SELECT 0
+                            WHERE NOT EXISTS (SELECT 1 FROM completion_cache_generation)''')
+            self._generation = self._read_generation()
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, so one is kept per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _read_generation(self) -> int:
+        return self._connection().execute("SELECT generation FROM completion_cache_generation").fetchone()[0]
+
+    def _sync(self, now: float) -> None:
+        # Invalidations bump a shared generation number. When another worker has
+        # bumped it, the memory tier of this worker is dropped.
+        if now - self._synced_at < self.SYNC_INTERVAL:
+            return
+        self._synced_at = now
+        generation = self._read_generation()
+        if generation != self._generation:
+            with self._lock:
+                self._entries.clear()
+            self._generation = generation
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        # Store in the memory tier and evict the least recently used entries over the cap
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        # Expired rows are removed through the expires_at index, then the rows
+        # that expire first while the tier holds more than max_disk_entries
+        expired = conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,)).rowcount
+        evicted = 0
+        if self.max_disk_entries is not None:
+            excess = conn.execute("SELECT COUNT(*) FROM completion_cache").fetchone()[0] - self.max_disk_entries
+            if excess > 0:
+                evicted = conn.execute('''DELETE FROM completion_cache WHERE key IN
+                                           (SELECT key FROM completion_cache ORDER BY expires_at LIMIT ?)''',
+                                       (excess,)).rowcount
+        with self._lock:
+            self.counters["disk_expirations"] += expired
+            self.counters["disk_evictions"] += evicted
+
+    def get(self, key: str, record_stats: bool = True) -> Optional[str]:
+        """
+        Returns the cached completion for key, or None on a miss. Set
+        record_stats to False for lookups that should not touch the counters.
+        """
+        now = time.time()
+        if self.path:
+            self._sync(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    if record_stats:
+                        self.counters["memory_hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+                self.counters["expirations"] += 1
+
+        if self.path:
+            c = self._connection().execute(
+                "SELECT value, expires_at FROM completion_cache WHERE key = ? AND expires_at > ?", (key, now))
+            row = c.fetchone()
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                if record_stats:
+                    with self._lock:
+                        self.counters["disk_hits"] += 1
+                return row[0]
+
+        if record_stats:
+            with self._lock:
+                self.counters["misses"] += 1
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Stores a completion in both tiers.
+        """
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, value, expires_at)
+        if self.path:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO completion_cache VALUES (?, ?, ?)", (key, value, expires_at))
+            # The file is kept bounded by pruning it every PRUNE_INTERVAL seconds, not on every write
+            if now - self._last_pruned >= PRUNE_INTERVAL:
+                self._last_pruned = now
+                self._prune(conn, now)
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        """
+        Removes the entry for key from both tiers, or every entry if key is None.
+
+        Returns:
+            int: The number of entries removed from the on-disk tier, or from
+            the memory tier if there is no on-disk tier.
+        """
+        with self._lock:
+            if key is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                removed = 1 if self._entries.pop(key, None) is not None else 0
+        if self.path:
+            conn = self._connection()
+            if key is None:
+                removed = conn.execute("DELETE FROM completion_cache").rowcount
+            else:
+                removed = conn.execute("DELETE FROM completion_cache WHERE key = ?", (key,)).rowcount
+            conn.execute("UPDATE completion_cache_generation SET generation = generation + 1")
+            self._generation = self._read_generation()
+        with self._lock:
+            self.counters["invalidations"] += removed
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters and the size of the memory tier.
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._entries)
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        return stats
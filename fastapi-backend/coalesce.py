@@ -0,0 +1,165 @@
+"""
+Coalesce.py file for ProxyGPT. This file contains the single-flight helper
+used to share one OpenAI call between identical in-flight requests.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for sharing results between requests of one worker
+import asyncio
+
+# Required for the cross-worker leases
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Awaitable, Callable, Optional
+
+
+# ------------- [Classes] -------------
+
+class LeaderCancelled(Exception):
+    """
+    Set on the shared future when the caller making the call was cancelled
+    (usually because its client disconnected). Waiting callers then retry,
+    and one of them makes the call instead.
+    """
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time and shares its result with every caller
+    that asks for the same key while the call is in flight.
+
+    Within a worker, callers wait on the future of the first caller. If the
+    first caller is cancelled, a waiting caller takes over the call. If a
+    lease database is given, workers also take a lease per key, and callers
+    in other workers poll a lookup function (usually the shared completion
+    cache) for the result until the lease is released or expires.
+    """
+
+    def __init__(self, lease_path: Optional[str] = None, lease_ttl: float = 180, poll_interval: float = 0.25):
+        self.lease_path = lease_path
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.owner = str(os.getpid())
+        self._inflight = {}
+        self._local = threading.local()
+        self.counters = {
+            "leaders": 0,
+            "coalesced_local": 0,
+            "coalesced_remote": 0,
+            "leader_handoffs": 0,
+        }
+
+        if self.lease_path:
+            conn = self._connection()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS completion_leases
+                            (key text PRIMARY KEY, owner text NOT NULL, expires_at real NOT NULL)''')
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, so one is kept per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.lease_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _try_lease(self, key: str) -> bool:
+        # Take the lease for key unless another worker holds an unexpired one
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM completion_leases WHERE key = ? AND expires_at <= ?", (key, now))
+            acquired = conn.execute("INSERT OR IGNORE INTO completion_leases VALUES (?, ?, ?)",
+                                    (key, self.owner, now + self.lease_ttl)).rowcount == 1
+            conn.execute("COMMIT")
+            return acquired
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _release_lease(self, key: str) -> None:
+        self._connection().execute("DELETE FROM completion_leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], lookup: Optional[Callable[[str], Optional[str]]] = None):
+        """
+        Returns the result of fn for key, sharing one call between all
+        concurrent callers with the same key.
+
+        Args:
+            key (str): Key identifying identical requests.
+            fn (callable): Coroutine function making the call.
+            lookup (callable): Optional function returning the stored result for
+                key, or None. Required to coalesce across workers.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            self.counters["coalesced_local"] += 1
+        while future is not None:
+            try:
+                return await asyncio.shield(future)
+            except LeaderCancelled:
+                # Take over the call, or wait on the caller that already did
+                future = self._inflight.get(key)
+                if future is None:
+                    self.counters["leader_handoffs"] += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._lead(key, fn, lookup)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # Cancelling the shared future would fail every waiting caller, so they are told to retry instead
+            future.set_exception(LeaderCancelled(key))
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case no other caller was waiting
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _lead(self, key: str, fn: Callable[[], Awaitable], lookup: Optional[Callable[[str], Optional[str]]]):
+        if not self.lease_path or lookup is None:
+            self.counters["leaders"] += 1
+            return await fn()
+
+        # Wait until this worker holds the lease or another worker has stored the result
+        while not self._try_lease(key):
+            result = lookup(key)
+            if result is not None:
+                self.counters["coalesced_remote"] += 1
+                return result
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            # The previous lease holder may have stored the result just before releasing
+            result = lookup(key)
+            if result is not None:
+                self.counters["coalesced_remote"] += 1
+                return result
+            self.counters["leaders"] += 1
+            return await fn()
+        finally:
+            self._release_lease(key)
+
+    def stats(self) -> dict:
+        """
+        Returns the coalescing counters and the number of keys in flight in this worker.
+        """
+        stats = dict(self.counters)
+        stats["coalesced"] = stats["coalesced_local"] + stats["coalesced_remote"]
+        stats["inflight"] = len(self._inflight)
+        return stats
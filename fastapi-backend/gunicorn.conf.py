@@ -0,0 +1,16 @@
+"""
+Gunicorn.conf.py file for ProxyGPT. Gunicorn loads this file automatically
+when it is started from this directory.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Hooks] -------------
+
+# Tell the Prometheus client that a worker exited, as required for its multiprocess mode
+def child_exit(server, worker):
+    import os
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
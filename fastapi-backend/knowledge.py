@@ -0,0 +1,209 @@
+"""
+Knowledge.py file for ProxyGPT. This file contains the local retrieval index
+over the book notes in the knowledge directory.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for reading the knowledge files
+import os
+import threading
+import time
+
+# Required for tokenizing and scoring
+from collections import Counter
+import math
+import re
+
+from typing import Dict, List
+
+
+# ------------- [Settings] -------------
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Common words that carry no meaning for retrieval
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have i if in into is it its me my of on or our
+so that the their them then there these they this to was we were what when which who
+will with you your
+""".split())
+
+# Pattern of the words used for indexing
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+# ------------- [Functions] -------------
+
+# Make function for estimating the number of tokens in a text
+def estimate_tokens(text: str) -> int:
+    """
+    This function estimates the number of tokens in a text, using the
+    rule of thumb of about four characters per token for English.
+    """
+    return (len(text) + 3) // 4
+
+# Make function for splitting text into index terms
+def tokenize(text: str) -> List[str]:
+    """
+    This function returns the lowercase words of a text, without stopwords.
+    """
+    return [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+
+# Make function for splitting a file into chunks
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """
+    This function splits text into chunks of whole paragraphs, each of at
+    most about max_tokens tokens. Longer paragraphs become chunks of their own.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        # Skip empty paragraphs and source markers such as [original]
+        if not paragraph or re.fullmatch(r"\[[^\]]*\]", paragraph):
+            continue
+        tokens = estimate_tokens(paragraph)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+# ------------- [Classes] -------------
+
+class Chunk:
+    """
+    A chunk of a knowledge file with its term counts.
+    """
+
+    __slots__ = ("source", "position", "text", "terms", "length", "tokens")
+
+    def __init__(self, source: str, position: int, text: str):
+        self.source = source
+        self.position = position
+        self.text = text
+        self.terms = Counter(tokenize(text))
+        self.length = sum(self.terms.values())
+        self.tokens = estimate_tokens(text)
+
+
+class KnowledgeIndex:
+    """
+    BM25 index over the text files of a directory.
+
+    Files are chunked when they are first seen and again only when their
+    modification time or size changes. The corpus statistics are rebuilt
+    from the cached chunks, which is cheap compared to reading and
+    tokenizing every file again. Changes are picked up on search, at most
+    once every reload_interval seconds.
+    """
+
+    def __init__(self, directory: str, chunk_tokens: int = 200, reload_interval: float = 5):
+        self.directory = directory
+        self.chunk_tokens = chunk_tokens
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._files = {}
+        # Chunks, document frequencies and average chunk length, swapped together on refresh
+        self._state = ([], Counter(), 0.0)
+        self._checked_at = 0.0
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Re-chunks changed files and rebuilds the corpus statistics.
+
+        Returns:
+            bool: True if the index changed.
+        """
+        now = time.time()
+        if not force and now - self._checked_at < self.reload_interval:
+            return False
+        with self._lock:
+            self._checked_at = now
+            files = {}
+            changed = False
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if not name.endswith(".txt") or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                signature = (stat.st_mtime, stat.st_size)
+                cached = self._files.get(name)
+                if cached is not None and cached[0] == signature:
+                    files[name] = cached
+                    continue
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+                files[name] = (signature, [Chunk(name, i, chunk) for i, chunk in enumerate(chunk_text(text, self.chunk_tokens))])
+                changed = True
+            if not changed and files.keys() == self._files.keys():
+                return False
+
+            chunks = [chunk for name in sorted(files) for chunk in files[name][1]]
+            document_frequency = Counter()
+            for chunk in chunks:
+                document_frequency.update(chunk.terms.keys())
+            average_length = sum(chunk.length for chunk in chunks) / max(len(chunks), 1)
+            self._files = files
+            self._state = (chunks, document_frequency, average_length)
+            return True
+
+    def search(self, query: str, top_k: int, token_budget: int) -> List[Chunk]:
+        """
+        Returns the best matching chunks for query, at most top_k of them and
+        at most token_budget tokens in total, in the order of the files.
+        """
+        self.refresh()
+        chunks, document_frequency, average_length = self._state
+        average_length = average_length or 1.0
+
+        terms = set(tokenize(query))
+        scored = []
+        for index, chunk in enumerate(chunks):
+            score = 0.0
+            for term in terms:
+                frequency = chunk.terms.get(term)
+                if not frequency:
+                    continue
+                df = document_frequency[term]
+                idf = math.log(1 + (len(chunks) - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * chunk.length / average_length))
+            scored.append((score, index))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+
+        selected = []
+        used_tokens = 0
+        for score, index in scored:
+            if len(selected) >= top_k:
+                break
+            chunk = chunks[index]
+            if used_tokens + chunk.tokens > token_budget:
+                continue
+            selected.append(index)
+            used_tokens += chunk.tokens
+        return [chunks[index] for index in sorted(selected)]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the number of files, chunks and estimated tokens in the index.
+        """
+        chunks = self._state[0]
+        return {
+            "files": len(self._files),
+            "chunks": len(chunks),
+            "tokens": sum(chunk.tokens for chunk in chunks),
+        }
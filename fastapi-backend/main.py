@@ -13,30 +13,70 @@ License: MIT
 from fastapi import FastAPI, HTTPException, Depends, Security
 from fastapi.security.api_key import APIKeyHeader, APIKey
 from fastapi.security import HTTPBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
 
 # Required libraries from Pydantic for API functionality
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 # Required for environment variables
 import os
 
+# Required for running batch completions concurrently
+import asyncio
+
 # Required for inspecting code
 import inspect
 
 # Import required libraries from OpenAI for API functionality
 import openai
 
-# Required for rate limiting with database and timestamps
-import sqlite3
-import time
+# Required for non-blocking calls to OpenAI with a pooled HTTP session
+from upstream import create_chat_completion, close_session, configure_pool, parse_pool_spec, PoolMember, UpstreamPool
+
+# Required for rate limiting with sliding window counters
+from ratelimit import create_rate_limiter, current_bucket
+
+# Required for the tiered completion cache
+from cache import CompletionCache, make_cache_key
+
+# Required for bounding the OpenAI calls in flight
+from admission import AdmissionController, AdmissionRejected, AdmissionTicket
+
+# Required for hedging, retrying and failing over the OpenAI calls
+from resilience import ResilientCompleter, DeadlineExceeded
+
+# Required for coalescing identical in-flight requests
+from coalesce import SingleFlight
+
+# Required for streaming coaching responses as Server-Sent Events
+from streaming import CoachingStreamParser, format_sse
+
+# Required for building the coaching prompts
+from prompts import build_joycoach_messages, build_system_prompt_parts, JOYCOACH_BOOK_NOTES, JOYCOACH_SYSTEM_PROMPT
+
+# Required for counting tokens locally and choosing max_tokens
+from tokens import TokenCounter, MaxTokensPolicy, CompletionPlan
+
+# Required for selecting the relevant book notes of each request
+from knowledge import KnowledgeIndex, estimate_tokens
+
+# Required for the conversation histories of the session endpoint
+from sessions import SessionStore, Turn, compact_response
+import re
+import secrets
+
+# Required for sending the Discord notifications in the background
+from webhook import WebhookDispatcher
+
+# Required for the Prometheus metrics and the Server-Timing header
+from metrics import MetricsMiddleware, phase, record_token_usage, render_metrics, CONTENT_TYPE_LATEST, MAX_TOKENS_CHOSEN
 
 # Required for printing styled log messages 
 from utils import *
 
-# Required for sending web requests
-import requests
+# Required for writing batch results
 import json
 
 
@@ -71,18 +111,26 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Time every request for the Prometheus metrics and the Server-Timing header
+app.add_middleware(MetricsMiddleware)
+
 import logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger("joycoach")
 
 
 # ------------- [Initialization: Env] -------------
 
 # Optional ENV: (OK to be None)
 DISCORD_WEBHOOK = os.getenv("DISCORD_WEBHOOK")
+OPENAI_API_POOL = os.getenv("OPENAI_API_POOL")
 
 
 # Set OpenAI API key securely from environment variable
 openai.api_key = os.getenv("OPENAI_API_KEY")
+openai_pool_members = parse_pool_spec(OPENAI_API_POOL) if OPENAI_API_POOL is not None else []
+if openai.api_key is None and openai_pool_members:
+    openai.api_key = openai_pool_members[0]["api_key"]
 proxygpt_api_key = os.getenv("PROXYGPT_API_KEY")
 
 if USE_HOURLY_RATE_LIMIT:
@@ -90,6 +138,10 @@ if USE_HOURLY_RATE_LIMIT:
 if USE_DAILY_RATE_LIMIT:
     daily_rate_limit = (os.getenv("PROXYGPT_DAILY_RATE_LIMIT"))
 
+# Optional token budgets, next to the call limits
+hourly_token_limit = os.getenv("PROXYGPT_HOURLY_TOKEN_LIMIT")
+daily_token_limit = os.getenv("PROXYGPT_DAILY_TOKEN_LIMIT")
+
 # Initialization check
 initialization_transcript = ""
 critical_exist = False
@@ -107,6 +159,30 @@ elif openai.api_key.startswith("sk-")==False:
     initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY environment variable is not a valid secret key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
     critical_exist = True
 
+# Check every member of the upstream pool, if set
+if OPENAI_API_POOL is not None and len(openai_pool_members) == 0:
+    initialization_transcript += red_critical(f'[Critical] OPENAI_API_POOL environment variable is set but has no members. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    critical_exist = True
+pool_api_keys = set()
+for number, member in enumerate(openai_pool_members, start=1):
+    if len(member["api_key"]) <5 or member["api_key"].startswith("sk-")==False:
+        initialization_transcript += red_critical(f'[Critical] Member {number} of OPENAI_API_POOL is not a valid secret key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+    elif member["api_key"] in pool_api_keys:
+        initialization_transcript += yellow_warning(f'[Warning] Member {number} of OPENAI_API_POOL repeats the key of an earlier member, which does not add capacity. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+    pool_api_keys.add(member["api_key"])
+    if member["api_base"] is not None and member["api_base"].startswith(("http://", "https://"))==False:
+        initialization_transcript += red_critical(f'[Critical] Member {number} of OPENAI_API_POOL does not have a valid base URL. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+    try:
+        member["weight"] = float(member["weight"] or 1)
+        if member["weight"] <= 0:
+            raise ValueError
+    except ValueError:
+        initialization_transcript += red_critical(f'[Critical] Member {number} of OPENAI_API_POOL does not have a valid positive weight. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+        member["weight"] = 1.0
+
 # Check if the key is set
 if proxygpt_api_key is None:
     initialization_transcript += red_critical(f'[Critical] PROXYGPT_API_KEY environment variable is not set. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
@@ -137,6 +213,23 @@ if USE_DAILY_RATE_LIMIT:
     else:
         daily_rate_limit = int(daily_rate_limit)
 
+# Check if the token budget(s) are set correctly, if set
+if hourly_token_limit is not None:
+    if hourly_token_limit.isdigit() == False:
+        initialization_transcript += red_critical(f'[Critical] PROXYGPT_HOURLY_TOKEN_LIMIT environment variable is not a valid integer. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+        hourly_token_limit = None
+    else:
+        hourly_token_limit = int(hourly_token_limit)
+
+if daily_token_limit is not None:
+    if daily_token_limit.isdigit() == False:
+        initialization_transcript += red_critical(f'[Critical] PROXYGPT_DAILY_TOKEN_LIMIT environment variable is not a valid integer. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+        daily_token_limit = None
+    else:
+        daily_token_limit = int(daily_token_limit)
+
 # Print results of initialization check
 print("Initialization check:")
 print(initialization_transcript)    
@@ -146,58 +239,157 @@ else:
     print(green_success("No critical errors found in initialization check."))
 
 
-# ------------- [Initialization: DB] -------------
+# ------------- [Initialization: Upstream Pool] -------------
 
-# Check if database is needed for rate limiting
-if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT:
-    # Use SQLITE database to store API usage
-    # Create a table for API usage if it does not exist
-    conn = sqlite3.connect('proxygpt.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS api_usage
-                    (api_timestamp integer)''')
-    conn.commit()
-    conn.close()
+# Spread the OpenAI calls over the members of OPENAI_API_POOL, if set
+upstream_pool = None
+if openai_pool_members:
+    upstream_pool = UpstreamPool([
+        PoolMember(str(number), member["api_key"], member["api_base"], member["weight"])
+        for number, member in enumerate(openai_pool_members, start=1)
+    ])
+configure_pool(upstream_pool)
 
 
-# ------------- [Helper Functions] -------------
+# ------------- [Initialization: Rate Limiter] -------------
 
-# Make function for adding API usage
-def log_api_usage() -> None:
-    """
-    This function logs an instance of API usage to the SQLite database.
-    It only logs the instance if the rate limit is enabled.
-    """
-    if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT:
-        with sqlite3.connect('proxygpt.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO api_usage VALUES (?)", (int(time.time()),))
-            conn.commit()
+# Collect the enabled rate limits, keyed by the length of their rolling window in seconds
+rate_limits = {}
+if USE_HOURLY_RATE_LIMIT:
+    rate_limits[3600] = hourly_rate_limit
+if USE_DAILY_RATE_LIMIT:
+    rate_limits[86400] = daily_rate_limit
+
+# Collect the token budgets the same way
+token_limits = {}
+if hourly_token_limit is not None:
+    token_limits[3600] = hourly_token_limit
+if daily_token_limit is not None:
+    token_limits[86400] = daily_token_limit
+
+# Create the rate limiter engine. The database is only needed if a rate limit or token budget is enabled.
+if rate_limits or token_limits:
+    rate_limiter = create_rate_limiter(RATE_LIMIT_BACKEND, rate_limits, RATE_LIMIT_DB_PATH, token_limits)
+else:
+    rate_limiter = create_rate_limiter("memory", rate_limits)
+
+
+# ------------- [Initialization: Token Accounting] -------------
+
+# Count prompt tokens locally, and choose max_tokens from recent completion lengths
+token_counter = TokenCounter(JOYCOACH_MODEL)
+max_tokens_policy = MaxTokensPolicy(
+    JOYCOACH_COMPLETION_PARAMS["max_tokens"],
+    MAX_TOKENS_FLOOR,
+    MAX_TOKENS_PERCENTILE,
+    MAX_TOKENS_HEADROOM,
+    MAX_TOKENS_MIN_SAMPLES,
+    JOYCOACH_CONTEXT_WINDOW,
+    adaptive=USE_ADAPTIVE_MAX_TOKENS
+)
+
+
+# ------------- [Initialization: Completion Cache] -------------
+
+# Create the completion cache shared by the coaching endpoints
+if USE_COMPLETION_CACHE:
+    completion_cache = CompletionCache(CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_DB_PATH, CACHE_DISK_MAX_ENTRIES)
+
+
+# ------------- [Initialization: Knowledge] -------------
+
+# Load, chunk and index the book notes if the system prompt is built from retrieved notes
+if KNOWLEDGE_PROMPT_MODE == "retrieval":
+    knowledge_index = KnowledgeIndex(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), KNOWLEDGE_DIR),
+        KNOWLEDGE_CHUNK_TOKENS,
+        KNOWLEDGE_RELOAD_INTERVAL
+    )
+
+
+# ------------- [Initialization: Admission Control] -------------
+
+# Create the admission controller that bounds the OpenAI calls in flight in this worker
+admission_controller = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_DEADLINE)
+
+
+# ------------- [Initialization: Resilience] -------------
+
+# Create the resilience layer of the coaching completions. Retries and hedges are charged against the rate limits.
+resilient_completer = ResilientCompleter(
+    create_chat_completion,
+    JOYCOACH_MODEL,
+    JOYCOACH_FALLBACK_MODEL,
+    charge=lambda: charge_extra_call(),
+    deadline=UPSTREAM_DEADLINE,
+    max_attempts=UPSTREAM_MAX_ATTEMPTS,
+    backoff=UPSTREAM_RETRY_BACKOFF,
+    max_backoff=UPSTREAM_RETRY_MAX_BACKOFF,
+    use_hedging=USE_HEDGING,
+    hedge_percentile=HEDGE_PERCENTILE,
+    hedge_min_samples=HEDGE_MIN_SAMPLES,
+    hedge_min_delay=HEDGE_MIN_DELAY,
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=BREAKER_RESET_TIMEOUT
+)
+
+
+# ------------- [Initialization: Request Coalescing] -------------
+
+# Create the single-flight helper. Other workers pick up results from the completion cache.
+if USE_CROSS_WORKER_COALESCING and USE_COMPLETION_CACHE:
+    single_flight = SingleFlight(COALESCE_DB_PATH, COALESCE_LEASE_TTL, COALESCE_POLL_INTERVAL)
+    coalesce_lookup = lambda key: completion_cache.get(key, record_stats=False)
+else:
+    single_flight = SingleFlight()
+    coalesce_lookup = None
+
+
+# ------------- [Initialization: Sessions] -------------
+
+# Create the store of conversation histories shared by all workers
+session_store = SessionStore(SESSION_DB_PATH, SESSION_MAX_BYTES, SESSION_TTL, SESSION_HISTORY_TOKENS, SESSION_SUMMARY_TOKENS)
+
+# Session IDs chosen by clients must be short and URL-safe
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+# ------------- [Initialization: Discord Webhook] -------------
+
+# Create the dispatcher that sends the Discord notifications off the response path
+webhook_dispatcher = None
+if DISCORD_WEBHOOK:
+    webhook_dispatcher = WebhookDispatcher(
+        DISCORD_WEBHOOK,
+        WEBHOOK_QUEUE_SIZE,
+        WEBHOOK_FLUSH_INTERVAL,
+        WEBHOOK_MAX_RETRIES,
+        WEBHOOK_SPILL_PATH
+    )
+
+
+# ------------- [Helper Functions] -------------
 
 # Make function for getting API usage (hourly)
 def get_api_usage_from_last_hour() -> int:
     """
     This function returns the number of API calls to OpenAI in the last hour.
     """
-    with sqlite3.connect('proxygpt.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM api_usage WHERE api_timestamp > ?", (int(time.time())-3600,))
-        return c.fetchone()[0]
+    return rate_limiter.usage(3600)
 
 # Make function for getting API usage (daily)
 def get_api_usage_from_last_day() -> int:
     """
     This function returns the number of API calls to OpenAI in the last day.
     """
-    with sqlite3.connect('proxygpt.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM api_usage WHERE api_timestamp > ?", (int(time.time())-86400,))
-        return c.fetchone()[0]
+    return rate_limiter.usage(86400)
 
 # Make function for checking rate limit
-def check_rate_limit() -> bool:
+def check_rate_limit(amount: int = 1, tokens: int = 0, bucket: Optional[int] = None) -> bool:
     """
-    This function checks if the rate limit has been reached.
+    This function checks if the rate limit has room for amount more calls
+    and the token budget for tokens more tokens and, if they have, logs them
+    as API usage in the same atomic step, in bucket or the current minute.
 
     Note that both hourly and daily rate limits can simultaneously be 
     in effect.
@@ -205,12 +397,256 @@ def check_rate_limit() -> bool:
     Returns:
         bool: True if rate limit has not been reached, False otherwise.
     """
-    if USE_HOURLY_RATE_LIMIT and get_api_usage_from_last_hour() >= hourly_rate_limit:
-        return False
-    if USE_DAILY_RATE_LIMIT and get_api_usage_from_last_day() >= daily_rate_limit:
-        return False
+    return rate_limiter.acquire(amount, tokens, bucket)
+
+# Make function for charging a retry or hedge
+def charge_extra_call(tokens: int = 0, bucket: Optional[int] = None) -> bool:
+    """
+    This function logs one instance of API usage for a retried or hedged
+    OpenAI call, with its prompt tokens, if it fits within the rate limit.
+    The usage is logged in bucket or the current minute.
+
+    Returns:
+        bool: True if the call was logged, False if the rate limit has been reached.
+    """
+    with phase("ratelimit"):
+        return check_rate_limit(1, tokens, bucket)
+
+# Make function for planning a completion
+def plan_completion(messages: list, system_parts: Optional[List[str]] = None) -> CompletionPlan:
+    """
+    This function counts the prompt tokens of the messages locally and
+    chooses max_tokens from the prompt size and recent completion lengths.
+    The system prompt is counted from the cached counts of system_parts, the
+    texts it was joined from, when they are given.
+    """
+    prompt_tokens = token_counter.count_messages(messages, system_parts)
+    max_tokens = max_tokens_policy.choose(prompt_tokens)
+    MAX_TOKENS_CHOSEN.observe(max_tokens)
+    return CompletionPlan(messages, prompt_tokens, max_tokens)
+
+# Make function for settling the tokens reserved for a completion
+def settle_token_usage(plan: CompletionPlan, usage: Optional[dict] = None, finish_reason: Optional[str] = None) -> None:
+    """
+    This function replaces the tokens reserved for a completion (prompt and
+    max_tokens) with the actual prompt and completion tokens in the usage
+    store. Without usage, for a failed call, the prompt stays charged. The
+    difference is settled in the bucket the tokens were reserved in.
+    """
+    if usage:
+        record_token_usage(usage)
+        max_tokens_policy.record(usage.get("completion_tokens", 0), truncated=finish_reason == "length")
+        actual = usage.get("prompt_tokens", plan.prompt_tokens) + usage.get("completion_tokens", 0)
     else:
-        return True
+        actual = plan.prompt_tokens
+    with phase("ratelimit"):
+        rate_limiter.adjust(tokens=actual - plan.reserved_tokens, bucket=plan.bucket)
+
+# Make function for refunding a completion that was never sent
+def refund_completion(plan: CompletionPlan) -> None:
+    """
+    This function removes the call and the tokens reserved for a completion
+    that was never sent to OpenAI from the usage store.
+    """
+    with phase("ratelimit"):
+        rate_limiter.adjust(-1, -plan.reserved_tokens, bucket=plan.bucket)
+
+
+# Make function for getting the cache key of a coaching request
+def get_completion_cache_key(message: str) -> str:
+    """
+    This function returns the completion cache key of a message. The prompt
+    mode is part of the key, since full and retrieved book notes can lead to
+    different answers.
+    """
+    return make_cache_key(message, JOYCOACH_MODEL, dict(JOYCOACH_COMPLETION_PARAMS, prompt_mode=KNOWLEDGE_PROMPT_MODE))
+
+# Make function for looking up a cached completion
+def get_cached_completion(cache_key: str) -> Optional[str]:
+    """
+    This function returns the cached completion for a cache key, or None
+    on a miss or if the completion cache is disabled.
+    """
+    if not USE_COMPLETION_CACHE:
+        return None
+    with phase("cache"):
+        return completion_cache.get(cache_key)
+
+# Make function for building the prompt of a coaching request
+def build_coaching_prompt(message: str) -> tuple:
+    """
+    This function returns the chat messages for a message, and the texts its
+    system prompt was joined from. In retrieval mode the system prompt only
+    holds the book notes most relevant to the message, joined from the fixed
+    wrapper and each chunk, otherwise it holds the full book notes.
+
+    Returns:
+        tuple: The chat messages and the parts of the system prompt.
+    """
+    if KNOWLEDGE_PROMPT_MODE == "retrieval":
+        chunks = knowledge_index.search(message, KNOWLEDGE_TOP_K, KNOWLEDGE_TOKEN_BUDGET)
+        system_parts = build_system_prompt_parts([chunk.text for chunk in chunks])
+        return build_joycoach_messages(message, "".join(system_parts)), system_parts
+    return build_joycoach_messages(message), [JOYCOACH_SYSTEM_PROMPT]
+
+# Make function for building the chat messages of a coaching request
+def build_coaching_messages(message: str) -> list:
+    """
+    This function returns the chat messages for a message, see
+    build_coaching_prompt.
+    """
+    return build_coaching_prompt(message)[0]
+
+# Make function for building the prompt of a session request
+def build_session_prompt(message: str, session) -> tuple:
+    """
+    This function returns the chat messages for a message within a session:
+    the system prompt, the history of the session within its token budget,
+    and the message. The parts of the system prompt are returned with them.
+
+    Returns:
+        tuple: The chat messages and the parts of the system prompt.
+    """
+    messages, system_parts = build_coaching_prompt(message)
+    return messages[:1] + session_store.build_history(session) + messages[1:], system_parts
+
+# Make function for enforcing the rate limit
+def enforce_rate_limit(amount: int = 1, tokens: int = 0) -> int:
+    """
+    This function logs amount instances of API usage with tokens reserved
+    tokens, or raises a 429 error if they do not fit within the rate limit
+    and token budget.
+
+    Returns:
+        int: The bucket the usage was logged in, to settle the tokens against.
+    """
+    bucket = current_bucket()
+    with phase("ratelimit"):
+        allowed = check_rate_limit(amount, tokens, bucket)
+    if allowed == False:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit reached. Try again later. See /ratelimit to view status and settings.",
+            headers={"Retry-After": str(rate_limiter.retry_after(amount, tokens))}
+        )
+    return bucket
+
+# Make function for admitting a request to call OpenAI
+async def admit_request(background: bool = False) -> AdmissionTicket:
+    """
+    This function waits until the admission controller lets the request call
+    OpenAI, and returns the ticket to release afterwards. Requests that can
+    not be served within their deadline are shed with a 503 error, and
+    requests that would hit the rate limit with a 429 error, both before any
+    usage is logged and with a Retry-After hint.
+    """
+    with phase("ratelimit"):
+        # One token checks that the token budget is not used up
+        allowed = rate_limiter.has_room(1, 1)
+    if allowed == False:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit reached. Try again later. See /ratelimit to view status and settings.",
+            headers={"Retry-After": str(max(1, rate_limiter.retry_after(1, 1)))}
+        )
+    try:
+        with phase("admission"):
+            return await admission_controller.acquire(background)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"{e.reason} Try again later. See /admission to view status and settings.",
+            headers={"Retry-After": str(max(e.retry_after, rate_limiter.retry_after()))}
+        )
+
+
+# Make function for sending a coaching notification to Discord
+def send_discord_notification(message: str, content: str, username: str = "Debug notification of successful coaching") -> None:
+    """
+    This function queues a notification of coaching usage for the Discord
+    webhook, for logging and debugging. It returns at once, the notification
+    is sent in the background. It does nothing if DISCORD_WEBHOOK is not set.
+    """
+    if webhook_dispatcher is not None:
+        webhook_dispatcher.notify(username, message + "\n\n" + content)
+
+# Make function for describing an error to the API client
+def get_client_error_message(e: Exception) -> str:
+    """
+    This function returns the error message passed to the API client. Error
+    details are only passed through when INSECURE_DEBUG is True.
+    """
+    logger.error("Request failed: %r", e)
+    if INSECURE_DEBUG:
+        return str(e)
+    return "Internal server error. Set INSECURE_DEBUG to True to view error details from client side."
+
+# Make function for calling OpenAI once for a planned completion
+async def call_plan(plan: CompletionPlan) -> tuple:
+    """
+    This function calls OpenAI for a planned completion and settles its
+    reserved tokens with the actual usage.
+
+    Returns:
+        tuple: The model's response, the model that answered and the finish reason.
+    """
+    try:
+        response, model = await resilient_completer.complete(
+            charge=lambda: charge_extra_call(plan.prompt_tokens),
+            messages=plan.messages,
+            **dict(JOYCOACH_COMPLETION_PARAMS, max_tokens=plan.max_tokens)
+        )
+    except BaseException:
+        settle_token_usage(plan)
+        raise
+    finish_reason = response.choices[0].get("finish_reason")
+    settle_token_usage(plan, response.get("usage"), finish_reason)
+    return response.choices[0].message['content'], model, finish_reason
+
+# Make function for completing a planned completion
+async def complete_plan(plan: CompletionPlan) -> tuple:
+    """
+    This function calls OpenAI for a planned completion. The first call and
+    its tokens must already be charged against the rate limit, retries and
+    hedges are charged with their prompt tokens as they are sent.
+
+    If the reply was cut off at a max_tokens below the largest allowed, it is
+    asked for once more with the largest max_tokens, charged as an extra call.
+    A reply that still did not finish with "stop" must not be cached or
+    stored, since it is likely cut off.
+
+    Returns:
+        tuple: The model's response, the model that answered and the finish reason.
+    """
+    content, model, finish_reason = await call_plan(plan)
+    largest = max_tokens_policy.largest(plan.prompt_tokens)
+    if finish_reason == "length" and plan.max_tokens < largest:
+        retry = CompletionPlan(plan.messages, plan.prompt_tokens, largest, current_bucket())
+        if charge_extra_call(retry.reserved_tokens, retry.bucket):
+            content, model, finish_reason = await call_plan(retry)
+    return content, model, finish_reason
+
+# Make function for running a coaching completion
+async def run_coaching_completion(message: str, cache_key: str, plan: CompletionPlan) -> str:
+    """
+    This function calls OpenAI for a message, stores the response in the
+    completion cache and sends the Discord notification. The first call must
+    already be charged against the rate limit, see complete_plan.
+
+    Returns:
+        str: The model's response.
+    """
+    content, model, finish_reason = await complete_plan(plan)
+
+    # Answers of the fallback model are not cached, so the situation is answered by GPT-4 again once it recovers.
+    # Answers that were cut off are not cached either.
+    if USE_COMPLETION_CACHE and model == JOYCOACH_MODEL and finish_reason == "stop":
+        completion_cache.set(cache_key, content)
+
+    # Sends notification of coaching usage for logging and debugging
+    send_discord_notification(message, content)
+
+    return content
 
 
 # ------------- [Classes and Other] -------------
@@ -220,104 +656,365 @@ class ChatMessage(BaseModel):
     role: str
     content: str
 
+# Define a model of a batch of coaching messages
+class BatchCoachingRequest(BaseModel):
+    messages: List[str]
+
+# Define a model of the stored history of a session
+class SessionHistory(BaseModel):
+    session_id: str
+    summary: str
+    messages: List[ChatMessage]
+
+# Headers for Server-Sent Event responses. X-Accel-Buffering stops proxies from buffering the stream.
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
 # Define a security scheme for API key
 bearer_scheme = HTTPBearer()
 
 # Define validation function for API key
 def valid_api_key(api_key_header: APIKey = Depends(bearer_scheme)):
     # Check if API key is valid
-    if api_key_header.credentials != proxygpt_api_key:
+    with phase("auth"):
+        valid = api_key_header.credentials == proxygpt_api_key
+    if not valid:
         raise HTTPException(
             status_code=400, detail="Invalid API key"
         )
     return api_key_header.credentials
 
-# Define validation function for API key with rate limit
-def valid_api_key_rate_limit(api_key_header: APIKey = Depends(bearer_scheme)):
-    # Check if rate limit has been reached
-    if check_rate_limit() == False:
-        raise HTTPException(status_code=429, detail="Rate limit reached. Try again later. See /ratelimit to view status and settings.")
 
-    # Check if API key is valid
-    if api_key_header.credentials != proxygpt_api_key:
-        raise HTTPException(
-            status_code=400, detail="Invalid API key"
-        )
-    return api_key_header.credentials
+# ------------- [Lifecycle Events] -------------
+
+# Start sending the Discord notifications when the worker starts
+@app.on_event("startup")
+async def start_webhook_dispatcher():
+    if webhook_dispatcher is not None:
+        await webhook_dispatcher.start()
+
+# Send the queued Discord notifications when the worker shuts down
+@app.on_event("shutdown")
+async def stop_webhook_dispatcher():
+    if webhook_dispatcher is not None:
+        await webhook_dispatcher.stop(WEBHOOK_SHUTDOWN_TIMEOUT)
+
+# Close the pooled upstream session when the worker shuts down
+@app.on_event("shutdown")
+async def shutdown_upstream_session():
+    await close_session()
 
 
 # ------------- [Routes and Endpoints] -------------
 
 # Define a route for the root path
 @app.post('/api/openai/joycoachgpt')
-async def get_openai_joycoach_completion(message: str, api_key: str = Depends(valid_api_key_rate_limit)):
+async def get_openai_joycoach_completion(message: str, api_key: str = Depends(valid_api_key)):
     """
     This endpoint allows you to interact with OpenAI's GPT-4 model for Chat Completion with Custom System and User Prompts Pre-loaded.
 
     - **message**: A message string.
 
     The endpoint will return a string containing the model's response.
+    Repeated situations are answered from the completion cache, which does not count against the rate limits.
     """
 
+    # Check the completion cache before charging the rate limit
+    cache_key = get_completion_cache_key(message)
+    if USE_COMPLETION_CACHE:
+        content = get_cached_completion(cache_key)
+        if content is not None:
+            return JSONResponse(status_code=200, content={"message": content})
+
+    # Make function for the upstream call, shared by identical requests in flight
+    async def complete() -> str:
+        ticket = await admit_request()
+        try:
+            # Check if rate limit has been reached, and log API usage with the reserved tokens if it has not
+            plan = plan_completion(*build_coaching_prompt(message))
+            plan.bucket = enforce_rate_limit(tokens=plan.reserved_tokens)
+            return await run_coaching_completion(message, cache_key, plan)
+        finally:
+            ticket.release()
+
     try:
-        # Log API usage. Note, you could move this to the end of the endpoint and check the response content if you want to log only successful requests.
-        log_api_usage()
-
-        custom_situation = message
-
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {
-                "role": "system",
-                "content": "<Book Notes>\n\n\n(A)\nYou are the conductor of your own dream. Lead people to the third gear. Search for both codreamers, people who can support and understand your dream, and cooperators, experts who can aid you in your dream.\n\nIt is worthwhile to invest your time in finding experts and resources. Ensure you contribute to position them where they are able to help you. However, you should have backup experts, as one person will not know everything, and you shouold have a group of people to consult. Do not undervalue your friends, coaches, and mentors. Some will be experts behind-the-scenes.\n\n(B)\nSharing your dream with others is important, and you should give people all the information: the what, when, where, why, and how. They can assist you in filling in the gaps and evolving your dream.\n\nTo be successful, you complete something, but it is also a commitment to a dream. Third-gear leaders have discretion to provide the space for experts to step up and achieve their dreams. You should remember that the success of others is also your success.\n\n(C)\nSuccess can be understood also as deletion-- you should release your past so you can stay on course. We all have things from our past that prevent us from accomplishing our goals. \n\nRe-viewing, re-thinking, re-deciding, re-leasing, re-dreaming, are all important.\n\nLook for places you avoid and fear, places you have failed repeatedly, where others upset us. This is where you should focus on releasing your past.\n\n(D)\nDeal with upsets in the moment, do not let them be unattended, for they will cause issues in the future.\n“Old upsets are set ups for upsets in the moment”\nSuccessful people update memories based upon what they know and do now. Re-experiencing and re-deciding based upon an updated perspective.\n\n\nSusan’s story:\nWorking as a researcher at the National Institutes of Health (NIH), Susan initially believed she would study the keys to success and what contributes to individuals becoming valuable members of society. However, she soon realized the focus was on illness and dysfunction. Undeterred by the laughter of senior psychologists when they expressed their opposing viewpoints, she remained steadfast and embarked on a mission to study successful people and uncover their unique skill sets. Through a serendipitous encounter with Buckminster Fuller, a renowned architect, Susan began her journey of learning and sharing skills with others.\n\n\nThe importance of believing in your dreams:\nSusan emphasizes the importance of believing in your dreams. She highlights the significance of being open to unconventional ideas, as they often hold the potential for remarkable breakthroughs, and the practice of success filing, where people foster a sense of self-worth and motivation by taking the time to acknowledge their daily achievements and milestones. She also stresses the power of celebrating the successes of others, as that creates a positive and supportive environment that uplifts individuals and teams.\n\n\nPromising ideas often get dismissed:\nWith extensive experience in corporate boardrooms and collaborating with numerous CEOs, Susan gained a profound understanding of the unfortunate reality where promising ideas frequently get dismissed and ridiculed, resulting in their failure to materialize.\n\n\nSuccess filing:\nOne of the skills Susan observed among successful individuals is what she refers to as success filing. It involves taking time each day to acknowledge your accomplishments, regardless of how insignificant they may seem. Success filing allows people to recognize their progress and build a positive mindset. Engaging in success filing only requires a few minutes of reflection to review the day’s actions, thoughts, lessons learned, and beneficial encounters. That practice cultivates self-awareness, motivation, and a sense of accomplishment.\n\nSuccess:\nMost people have never taken the time to define what success truly means to them. In exploring the concept, Susan discovered a three-fold understanding of success from conversations with successful people. Those individuals described success as encompassing three essential components. The first is completion, which involves finishing tasks and projects and acknowledging the accomplishment. The second is deletion, which refers to recognizing when a particular approach or strategy is not working and letting go of it to explore alternative paths. Finally, success can involve creation, where individuals can identify and commit to viable and innovative ideas and take action to bring them to fruition.\n\nFlexibility:\nFlexibility and adaptability are essential when approaching challenges or pursuing goals. Many people repeat the same actions and encounter the same obstacles without considering alternative approaches. Recognizing the need for a shift in strategy is crucial. It involves acknowledging the value of your ideas while being open to modifying them to better align with the situation at hand. You also need to know when to let go of an approach that is not working.\n\nEnvisioning your success to perform better:\nBy programming your brain’s reticular activating system correctly, you can tap into your unconscious abilities and perform better. However, if you dwell on old painful memories or have been through a series of negative experiences, fear could dominate your thinking, leading to constant anticipation of negative outcomes.\n\n\nPart one focuses on : What They Didn’t Tell You About Success— that You Need to Know while Part Two dwells on : The Rest of the Skills You Will Need— to Make the Changes You Want\n\nIn Part one  Susan explains the meaning of Success and how it affects one personally.\n\nSuccess is completion of what you set out to do.  No matter how big or small the task may seem, the satisfaction you get when you complete it determines your level of success.  She also mentions that\n\nSuccess is being able to let go of an unworkable method or system. An outgrown relationship you’ve tried everything conceivable to fix. A well-paying job you’ve done the same way far too many times.\nSuccess is quitting smoking or giving up caffeine, sugar, or drugs; or letting go of your society-rewarded addiction to old rules, hard work, money, or power.\nSuccess is cutting out, down, or back.\n\nHow a person defines success varies from person to person and the definition is certainly not universal. To attain success is to be able to reach ones’ dream.\n\nHaving a detailed dream makes it easier to act on.  The more detailed your dream is the more power it has.\n\nWith a plan in mind it is easier for one to move towards the goal/dreams to obtain success.\n\n\n1. Concept of Success:\nSuccess is a personal journey; it's not just about achievement but also about letting go of what doesn't work.\nSuccess encompasses completion (achieving goals), deletion (letting go of ineffective methods), and creation (innovating and executing new ideas).\n\n\n2. Success Filing:\nA practice where individuals acknowledge daily accomplishments to foster self-worth and motivation.\nIt involves reflecting on actions, thoughts, and lessons learned each day.\n\n\n3. Belief in Dreams:\nEmphasizes the importance of believing in and being open to unconventional ideas.\nEncourages celebrating personal and others' successes to create a supportive environment.\n\n\n4. Challenges in Corporate Environments:\nObservations on how promising ideas are often dismissed in corporate settings.\nStresses the importance of perseverance and belief in one's ideas.\n\n\n5. Flexibility and Adaptability:\nRecognizing the need to shift strategies when facing obstacles.\nBeing open to modifying ideas to better suit situations.\n\n\n6. The Power of Vision:\nUtilizing the brain’s reticular activating system to focus on positive outcomes.\nOvercoming fear and negative experiences through positive thinking.\n\n\n7. Networking and Collaboration:\nImportance of finding experts, mentors, and supporters who understand and support your dreams.\nEmphasizing the value of a diverse support system and the role of mentors and friends.\n\n\n8. Sharing Dreams:\nImportance of communicating one's dreams and goals to others.\nEncouraging collaboration to fill gaps and evolve ideas.\n\n\n9. Dealing with the Past:\nAdvocating for letting go of past failures and negative experiences to stay focused on goals.\nEmphasis on re-evaluating and updating one's perspective based on new experiences and knowledge.\n\n\nSuccess is completion. Success is deletion. Success is also creation and cocreation. When your Success File is full, you feel success-full. Success in your past gives you confidence in your future.\n\nFirst Gear is learning the basics. In First Gear, you depend on a leader to guide you step by step, whether in person, on the phone, or in writing, as you begin to use your new skill safely and correctly. Then your friend goes home and you start practicing on your own. Because it may not seem as clear now as it did when she was there beside you, you call her to ask specific questions as you continue to build your new skill. Now instead of just trying to get on the Internet, you begin using it tofind information and people. It's easier and faster now, except for occasional glitches that require an additional call or visit.\n\nSecond Gear is moving ahead to why you wanted to learn it in the first place-so you could use it. Confident and experienced, you pursue your goals and interests more efficiently. The next time you talk to your friend, you catch yourself sharing discoveries you've made and telling her how to use them.\n\nThird Gear is breaking through what you've been taught - the beginner set of rules and limits-to create your own way and pass on your discoveries. Now you take on your own student, teach him the basics, help him get up and running, and creative. And then he teaches a friend... This is how the Success and Leadership Process works - ideally.\n\nSuccess in First Gear is following rules and earning praise.\nSuccess in Second Gear is producing results and getting ahead.\nSuccess in Third Gear is creating *your* dreams, alone and with others.\n\nTo lead your life skillfully you need to manually shift up and down as circumstances and conditions require, just as a skillful driver does.\n\n</Book Notes>\n\n\nYou are a system which always provides a JSON-formatted response. Below is an example of the structure you must rigidly follow.\n\n{\n  \"response_to_user\": \" \",\n  \"skill-specific-responses\": [\n    {\n      \"skill-brief-title\": \"\",\n      \"skill-application\": \"Description of how skill 1 is applied\"\n    },\n    {\n      \"skill-brief-title\": \"\",\n      \"skill-application\": \"Description of how skill 2 is applied\"\n    },\n    // ... add more skill applications as needed\n  ]\n}\n"
-                },
-                {
-                "role": "user",
-                "content": f"Apply the book content (ONLY write what is included in the book notes) to the following situation, using the JSON format provided:\n\n\"{custom_situation}\"\nPlease be concise."
-                }
-            ],
-            temperature=0.2,
-            max_tokens=3000,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
+        content = await single_flight.do(cache_key, complete, lookup=coalesce_lookup)
 
-        content = response.choices[0].message['content']
-        
+        return JSONResponse(status_code=200, content={"message": content})
+    except HTTPException:
+        raise
+    except DeadlineExceeded:
+        return JSONResponse(status_code=504, content={"error": "OpenAI did not respond in time. Try again later."})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": get_client_error_message(e)})
 
-        # Sends notification of coaching usage for logging and debugging
-        if DISCORD_WEBHOOK:
-            #Send discord webhook notification of response
-            data = {
-                "content": message + "\n\n"+content,
-                "username": "Debug notification of successful coaching"
-            }
+# Define a route for the streaming variant of the coaching endpoint
+@app.post('/api/openai/joycoachgpt/stream')
+async def stream_openai_joycoach_completion(message: str, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint streams the response of the coaching endpoint as Server-Sent Events.
+
+    - **message**: A message string.
+
+    Events:
+    - **token**: {"content": ...} for each piece of text received from OpenAI.
+    - **response**: {"response_to_user": ...} as soon as the response to the user is complete.
+    - **skill**: {"index": ..., "skill": {...}} as soon as each skill-specific response is complete.
+    - **done**: {"message": ...} with the full response once the stream has finished.
+    - **error**: {"error": ...} if the stream fails.
+    """
 
-            # Headers for the POST request
-            headers = {
-                "Content-Type": "application/json"
-            }
+    # Answer cached situations at once, without charging the rate limit
+    cache_key = get_completion_cache_key(message)
+    if USE_COMPLETION_CACHE:
+        content = get_cached_completion(cache_key)
+        if content is not None:
+            async def replay_cached():
+                yield format_sse("token", {"content": content})
+                for event, data in CoachingStreamParser().feed(content):
+                    yield format_sse(event, data)
+                yield format_sse("done", {"message": content})
+            return StreamingResponse(replay_cached(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    # Wait for admission, then check if rate limit has been reached, and log API usage with the reserved tokens if it has not
+    ticket = await admit_request()
+    try:
+        plan = plan_completion(*build_coaching_prompt(message))
+        plan.bucket = enforce_rate_limit(tokens=plan.reserved_tokens)
+    except BaseException:
+        # Until the response owns the ticket, any error must give the slot back
+        ticket.release()
+        raise
+    started = False
+
+    async def stream_completion():
+        nonlocal started
+        started = True
+        parser = CoachingStreamParser()
+        finished = False
+        finish_reason = None
+        try:
+            # Streams are not hedged or retried, since tokens sent can not be taken back, but they fail over
+            model = resilient_completer.choose_model()
+            try:
+                response = await create_chat_completion(
+                    model=model,
+                    messages=plan.messages,
+                    stream=True,
+                    **dict(JOYCOACH_COMPLETION_PARAMS, max_tokens=plan.max_tokens)
+                )
+            except BaseException as e:
+                resilient_completer.record_outcome(model, e)
+                raise
+            resilient_completer.record_outcome(model)
+            try:
+                async for chunk in response:
+                    finish_reason = chunk.choices[0].get('finish_reason') or finish_reason
+                    text = chunk.choices[0].delta.get('content')
+                    if not text:
+                        continue
+                    yield format_sse("token", {"content": text})
+                    for event, data in parser.feed(text):
+                        yield format_sse(event, data)
+            finally:
+                # Close the upstream stream so its connection returns to the pool, even on disconnect
+                await response.aclose()
+
+            finished = True
+            content = parser.buffer
+            # Streams can not be asked again, but answers that were cut off are not cached
+            if USE_COMPLETION_CACHE and model == JOYCOACH_MODEL and finish_reason == "stop":
+                completion_cache.set(cache_key, content)
+            yield format_sse("done", {"message": content})
+        except Exception as e:
+            yield format_sse("error", {"error": get_client_error_message(e)})
+        finally:
+            # Runs when the stream ends, fails, or is cancelled because the client disconnected.
+            # The call was already charged against the rate limit when the stream started, and
+            # streams do not report their usage, so the completion tokens are counted locally.
+            ticket.release()
+            usage = None
+            if parser.buffer:
+                usage = {"prompt_tokens": plan.prompt_tokens, "completion_tokens": token_counter.count(parser.buffer)}
+            settle_token_usage(plan, usage, finish_reason)
+            if finished:
+                send_discord_notification(message, parser.buffer)
+            elif parser.buffer:
+                send_discord_notification(message, parser.buffer, username="Debug notification of interrupted coaching")
+
+    # Runs after the response. Releases the admission slot and refunds the reserved call and tokens if the stream never started.
+    def release_unstarted_stream():
+        ticket.release()
+        if not started:
+            refund_completion(plan)
+
+    return StreamingResponse(stream_completion(), media_type="text/event-stream", headers=SSE_HEADERS,
+                             background=BackgroundTask(release_unstarted_stream))
+
+# Define a route for the batch variant of the coaching endpoint
+@app.post('/api/openai/joycoachgpt/batch')
+async def batch_openai_joycoach_completion(batch: BatchCoachingRequest, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint answers a batch of coaching messages with one request.
 
-            # Send POST request to the webhook URL
-            response = requests.post(DISCORD_WEBHOOK, data=json.dumps(data), headers=headers)
+    - **messages**: A list of message strings.
 
+    Rate limit capacity for the whole batch is reserved up front, and the batch is rejected with 429 if it does not fit.
+    Cached and duplicate messages are not charged. Results are streamed back as newline-delimited JSON in the order
+    they finish, one line per message: {"index": ..., "message": ...} or {"index": ..., "error": ...}.
+    """
+    if len(batch.messages) > BATCH_MAX_MESSAGES:
+        raise HTTPException(status_code=413, detail=f"Batch is too large. The maximum is {BATCH_MAX_MESSAGES} messages.")
+
+    # Group the messages by cache key, so duplicates share one completion
+    indexes_by_key = {}
+    messages_by_key = {}
+    for index, message in enumerate(batch.messages):
+        cache_key = get_completion_cache_key(message)
+        indexes_by_key.setdefault(cache_key, []).append(index)
+        messages_by_key.setdefault(cache_key, message)
+
+    # Answer cached messages without charging the rate limit
+    cached = {}
+    if USE_COMPLETION_CACHE:
+        for cache_key in indexes_by_key:
+            content = get_cached_completion(cache_key)
+            if content is not None:
+                cached[cache_key] = content
+    pending = [cache_key for cache_key in indexes_by_key if cache_key not in cached]
+
+    # Reserve rate limit capacity and tokens for the whole batch in one step
+    plans = {cache_key: plan_completion(*build_coaching_prompt(messages_by_key[cache_key])) for cache_key in pending}
+    if pending:
+        bucket = enforce_rate_limit(len(pending), sum(plan.reserved_tokens for plan in plans.values()))
+        for plan in plans.values():
+            plan.bucket = bucket
+
+    # Items are marked as sent once they have been admitted, so the others can be refunded
+    sent = set()
+
+    def refund_unsent_items():
+        for cache_key in pending:
+            if cache_key not in sent:
+                sent.add(cache_key)
+                refund_completion(plans[cache_key])
+
+    async def stream_results():
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def run(cache_key: str) -> tuple:
+            async with semaphore:
+                # Batch items wait for admission without a deadline, in a background queue that is only served when no interactive request is waiting
+                ticket = await admission_controller.acquire(background=True)
+                sent.add(cache_key)
+                try:
+                    return cache_key, {"message": await run_coaching_completion(messages_by_key[cache_key], cache_key, plans[cache_key])}
+                except Exception as e:
+                    return cache_key, {"error": get_client_error_message(e)}
+                finally:
+                    ticket.release()
+
+        tasks = [asyncio.ensure_future(run(cache_key)) for cache_key in pending]
+        try:
+            for cache_key, content in cached.items():
+                for index in indexes_by_key[cache_key]:
+                    yield json.dumps({"index": index, "message": content}) + "\n"
+            for future in asyncio.as_completed(tasks):
+                cache_key, result = await future
+                for index in indexes_by_key[cache_key]:
+                    yield json.dumps(dict(index=index, **result)) + "\n"
+        finally:
+            # Stop the remaining completions if the client disconnects, and refund the calls and tokens of those never sent
+            for task in tasks:
+                task.cancel()
+            refund_unsent_items()
+
+    # The background task refunds the whole batch if the response never started
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson",
+                             background=BackgroundTask(refund_unsent_items))
+
+# Define a route for the session variant of the coaching endpoint
+@app.post('/api/openai/joycoachgpt/session')
+async def session_openai_joycoach_completion(message: str, session_id: Optional[str] = None, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint answers a coaching message within a conversation, so follow-up questions do not need to repeat the context.
 
-        return JSONResponse(status_code=200, content={"message": content})
+    - **message**: A message string.
+    - **session_id**: Optional ID of the session to continue, 8 to 64 letters, digits, - or _. A new session is started if it is left out or unknown.
+
+    The endpoint will return the model's response and the session ID to send with the next message.
+    Session responses are not cached, since they depend on the conversation.
+    """
+    if session_id is None:
+        session_id = secrets.token_urlsafe(16)
+    elif not SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=422, detail="Invalid session ID. Use 8 to 64 letters, digits, - or _.")
+
+    ticket = await admit_request()
+    try:
+        # Check if rate limit has been reached, and log API usage with the reserved tokens if it has not
+        session = session_store.get(session_id)
+        plan = plan_completion(*build_session_prompt(message, session))
+        plan.bucket = enforce_rate_limit(tokens=plan.reserved_tokens)
+        content, model, finish_reason = await complete_plan(plan)
+
+        # Keep the compact form of the response, so the history stays small. Answers that were cut off are not kept.
+        if finish_reason == "stop":
+            session_store.append(session_id, [Turn("user", message), Turn("assistant", compact_response(content))])
+
+        # Sends notification of coaching usage for logging and debugging
+        send_discord_notification(message, content)
+
+        return JSONResponse(status_code=200, content={"message": content, "session_id": session_id})
+    except HTTPException:
+        raise
+    except DeadlineExceeded:
+        return JSONResponse(status_code=504, content={"error": "OpenAI did not respond in time. Try again later."})
     except Exception as e:
-        if INSECURE_DEBUG:
-            return JSONResponse(status_code=500, content={"error": str(e)})
-        else:
-            print(e)
-            return JSONResponse(status_code=500, content={"error": "Internal server error. Set INSECURE_DEBUG to True to view error details from client side."})
+        return JSONResponse(status_code=500, content={"error": get_client_error_message(e)})
+    finally:
+        ticket.release()
 
+# Define a route for the GET of a session
+@app.get('/api/openai/joycoachgpt/session/{session_id}', response_model=SessionHistory)
+async def get_session_history(session_id: str, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the stored history of a session: the summary of older turns and the recent messages.
+    """
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+    return SessionHistory(
+        session_id=session_id,
+        summary=session.summary,
+        messages=[ChatMessage(role=turn.role, content=turn.content) for turn in session.turns]
+    )
+
+# Define a route for the DELETE of a session
+@app.delete('/api/openai/joycoachgpt/session/{session_id}')
+async def delete_session(session_id: str, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint deletes the history of a session.
+    """
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+    return JSONResponse(status_code=200, content={"message": "Session deleted."})
+
+# Define a route for the GET of /sessions
+@app.get('/sessions')
+async def get_session_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the number and size of the stored sessions, shared by all workers, and the evictions seen by the worker serving the request.
+    """
+    return JSONResponse(status_code=200, content=session_store.stats())
 
 # Define a route for the GET of /ratelimit
 @app.get('/ratelimit')
 async def get_ratelimit(api_key: str = Depends(valid_api_key)):
     """
-    This endpoint allows you to view the current rate limit status and settings.
+    This endpoint allows you to view the current rate limit status and settings, in calls and in tokens.
     """
 
     # Return rate limit status and settings if rate limits are enabled
@@ -328,7 +1025,115 @@ async def get_ratelimit(api_key: str = Depends(valid_api_key)):
     if USE_HOURLY_RATE_LIMIT:
         json_to_return["hourly_rate_limit"] = hourly_rate_limit
         json_to_return["hourly_api_usage"] = get_api_usage_from_last_hour()
+    if daily_token_limit is not None:
+        json_to_return["daily_token_limit"] = daily_token_limit
+    if USE_DAILY_RATE_LIMIT or daily_token_limit is not None:
+        json_to_return["daily_token_usage"] = rate_limiter.token_usage(86400)
+    if hourly_token_limit is not None:
+        json_to_return["hourly_token_limit"] = hourly_token_limit
+    if USE_HOURLY_RATE_LIMIT or hourly_token_limit is not None:
+        json_to_return["hourly_token_usage"] = rate_limiter.token_usage(3600)
     if len(json_to_return) == 0:
         json_to_return = {"error": "Rate limit is not enabled."}
 
-    return JSONResponse(status_code=200, content=json_to_return)
\ No newline at end of file
+    return JSONResponse(status_code=200, content=json_to_return)
+
+# Define a route for the GET of /tokens
+@app.get('/tokens')
+async def get_token_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view how the worker serving the request counts prompt tokens and chooses max_tokens from recent completion lengths.
+    """
+    return JSONResponse(status_code=200, content={"counter": token_counter.stats(), "max_tokens": max_tokens_policy.stats()})
+
+# Define a route for the GET of /metrics
+@app.get('/metrics')
+async def get_metrics(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint exposes the latency, token and error metrics in the Prometheus text format, aggregated over all workers when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+# Define a route for the GET of /admission
+@app.get('/admission')
+async def get_admission_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the admission queue of the worker serving the request: calls in flight, queue depth, wait times and shed counts.
+    """
+    return JSONResponse(status_code=200, content=admission_controller.stats())
+
+# Define a route for the GET of /resilience
+@app.get('/resilience')
+async def get_resilience_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the hedges, retries, fallbacks, circuit breaker state and recent OpenAI latencies of the worker serving the request.
+    """
+    return JSONResponse(status_code=200, content=resilient_completer.stats())
+
+# Define a route for the GET of /upstream
+@app.get('/upstream')
+async def get_upstream_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the members of the upstream pool as seen by the worker serving the request: calls in flight, 429s, errors, latency and ejections. Keys are masked.
+    """
+    if upstream_pool is None:
+        return JSONResponse(status_code=200, content={"error": "Upstream pool is not configured. Set OPENAI_API_POOL to use several keys."})
+    return JSONResponse(status_code=200, content=upstream_pool.stats())
+
+# Define a route for the GET of /coalescing
+@app.get('/coalescing')
+async def get_coalescing_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view how many requests of the worker serving the request shared an in-flight OpenAI call.
+    """
+    return JSONResponse(status_code=200, content=single_flight.stats())
+
+# Define a route for the GET of /knowledge
+@app.get('/knowledge')
+async def get_knowledge(message: Optional[str] = None, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the prompt mode and the size of the book notes.
+
+    - **message**: Optional message string. If given, the system prompt that would be sent for it is included, for comparison between modes.
+    """
+    json_to_return = {
+        "prompt_mode": KNOWLEDGE_PROMPT_MODE,
+        "full_book_notes_tokens": estimate_tokens(JOYCOACH_BOOK_NOTES),
+    }
+    if KNOWLEDGE_PROMPT_MODE == "retrieval":
+        json_to_return["index"] = knowledge_index.stats()
+    if message is not None:
+        system_prompt = build_coaching_messages(message)[0]["content"]
+        json_to_return["system_prompt"] = system_prompt
+        json_to_return["system_prompt_tokens"] = estimate_tokens(system_prompt)
+
+    return JSONResponse(status_code=200, content=json_to_return)
+
+# Define a route for the GET of /cache
+@app.get('/cache')
+async def get_cache_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the completion cache counters of the worker serving the request.
+    """
+    if not USE_COMPLETION_CACHE:
+        return JSONResponse(status_code=200, content={"error": "Completion cache is not enabled."})
+
+    return JSONResponse(status_code=200, content=completion_cache.stats())
+
+# Define a route for the DELETE of /cache
+@app.delete('/cache')
+async def invalidate_cache(message: Optional[str] = None, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to invalidate cached completions.
+
+    - **message**: Optional message string. If given, only the entry for this message is invalidated, otherwise the whole cache is cleared.
+    """
+    if not USE_COMPLETION_CACHE:
+        return JSONResponse(status_code=200, content={"error": "Completion cache is not enabled."})
+
+    if message is None:
+        removed = completion_cache.invalidate()
+    else:
+        removed = completion_cache.invalidate(get_completion_cache_key(message))
+
+    return JSONResponse(status_code=200, content={"invalidated": removed})
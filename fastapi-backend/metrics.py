@@ -0,0 +1,202 @@
+"""
+Metrics.py file for ProxyGPT. This file contains the Prometheus metrics and
+the per-request Server-Timing breakdown.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the per-request timings
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import time
+
+# Required for Prometheus metrics
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+
+# ------------- [Metrics] -------------
+
+# Buckets in seconds, from cache hits to the slowest completions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+# Buckets in seconds for the local checks
+CHECK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+# Buckets in tokens
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000)
+
+REQUEST_LATENCY = Histogram(
+    "joycoach_request_duration_seconds", "Total time to respond to a request.",
+    ["endpoint"], buckets=LATENCY_BUCKETS)
+RESPONSES = Counter(
+    "joycoach_responses_total", "Responses by status code, including 429 and 500.",
+    ["endpoint", "status"])
+PHASE_LATENCY = Histogram(
+    "joycoach_phase_duration_seconds",
+    "Time spent per phase of a request: auth, ratelimit, admission, cache, upstream and webhook.",
+    ["phase"], buckets=LATENCY_BUCKETS)
+CHECK_LATENCY = Histogram(
+    "joycoach_check_duration_seconds", "Time per request spent on the auth and rate limit checks.",
+    buckets=CHECK_BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    "joycoach_upstream_errors_total", "Failed calls to OpenAI, by exception type.",
+    ["error"])
+UPSTREAM_MEMBER_CALLS = Counter(
+    "joycoach_upstream_member_calls_total",
+    "OpenAI calls per member of the upstream pool, by outcome: success, throttled or error.",
+    ["member", "outcome"])
+PROMPT_TOKENS = Histogram(
+    "joycoach_prompt_tokens", "Prompt tokens per completion, as reported by OpenAI.",
+    buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram(
+    "joycoach_completion_tokens", "Completion tokens per completion, as reported by OpenAI.",
+    buckets=TOKEN_BUCKETS)
+MAX_TOKENS_CHOSEN = Histogram(
+    "joycoach_max_tokens", "max_tokens chosen per completion from the prompt size and recent completion lengths.",
+    buckets=TOKEN_BUCKETS)
+UPSTREAM_HEDGES = Counter(
+    "joycoach_upstream_hedges_total",
+    "Hedged OpenAI calls: sent, won (answered first) or not_charged (skipped at the rate limit).",
+    ["outcome"])
+UPSTREAM_RETRIES = Counter(
+    "joycoach_upstream_retries_total", "Retried OpenAI calls, by the exception type of the failed call.",
+    ["error"])
+UPSTREAM_FALLBACKS = Counter(
+    "joycoach_upstream_fallbacks_total", "OpenAI calls sent to the fallback model while the circuit breaker was open.")
+CIRCUIT_BREAKER_STATE = Gauge(
+    "joycoach_circuit_breaker_state", "State of the circuit breaker of a model: 0 closed, 1 half open, 2 open.",
+    ["model"], multiprocess_mode="max")
+SESSION_STORE_SIZE = Gauge(
+    "joycoach_session_store_size", "Size of the shared session store, in sessions and in bytes.",
+    ["unit"], multiprocess_mode="livemax")
+SESSION_EVICTIONS = Counter(
+    "joycoach_session_evictions_total", "Sessions removed from the store: expired (idle) or lru (over the memory cap).",
+    ["reason"])
+WEBHOOK_NOTIFICATIONS = Counter(
+    "joycoach_webhook_notifications_total",
+    "Discord notifications by outcome: queued, sent, rejected, spilled or dropped.",
+    ["outcome"])
+
+# Phases that are local checks, also recorded together with the finer check buckets
+CHECK_PHASES = ("auth", "ratelimit")
+
+# Timings of the phases of the current request, in the order they were recorded
+_timings = ContextVar("timings", default=None)
+
+
+# ------------- [Functions] -------------
+
+# Make function for recording the time of a phase
+def record_phase_time(phase: str, seconds: float) -> None:
+    """
+    This function records the time spent in a phase of the current request.
+    Within a request the time is added up per phase and observed when the
+    request ends, otherwise it is observed at once.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+    else:
+        PHASE_LATENCY.labels(phase).observe(seconds)
+
+# Make function for observing the phase timings of a finished request
+def observe_timings(timings: dict) -> None:
+    """
+    This function records the phase timings of a finished request in the
+    Prometheus histograms.
+    """
+    for name, seconds in timings.items():
+        PHASE_LATENCY.labels(name).observe(seconds)
+    if any(name in timings for name in CHECK_PHASES):
+        CHECK_LATENCY.observe(sum(timings.get(name, 0.0) for name in CHECK_PHASES))
+
+# Make context manager for timing a phase
+@contextmanager
+def phase(name: str):
+    """
+    This context manager records the time spent in the wrapped block as the
+    phase name of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase_time(name, time.perf_counter() - start)
+
+# Make function for recording the token usage of a completion
+def record_token_usage(usage) -> None:
+    """
+    This function records the prompt and completion tokens reported by OpenAI.
+    """
+    if usage:
+        PROMPT_TOKENS.observe(usage.get("prompt_tokens", 0))
+        COMPLETION_TOKENS.observe(usage.get("completion_tokens", 0))
+
+# Make function for rendering the metrics
+def render_metrics() -> bytes:
+    """
+    This function returns the metrics in the Prometheus text format. When
+    PROMETHEUS_MULTIPROC_DIR is set, the metrics of all gunicorn workers are
+    aggregated, otherwise only the current process is reported.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+# Make function for formatting the Server-Timing header
+def format_server_timing(timings: dict, total: float) -> str:
+    """
+    This function returns the Server-Timing header value of the timings, in milliseconds.
+    """
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+# ------------- [Classes] -------------
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every request, counts responses by status
+    code and adds a Server-Timing header with the phases recorded before
+    the response started. Streaming responses are timed until their last
+    byte, but their header can only hold the phases before the first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = {}
+        token = _timings.set(timings)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", format_server_timing(timings, time.perf_counter() - start).encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+            endpoint = scope.get("endpoint")
+            endpoint = endpoint.__name__ if endpoint is not None else "unmatched"
+            REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+            observe_timings(timings)
+            RESPONSES.labels(endpoint, str(status[0])).inc()
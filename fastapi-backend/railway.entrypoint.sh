@@ -1,3 +1,8 @@
 #!/bin/sh
 
+# Aggregate the Prometheus metrics of all workers in a shared directory, cleared on start
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/joycoach-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app --log-level debug
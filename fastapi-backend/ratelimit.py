@@ -0,0 +1,389 @@
+"""
+Ratelimit.py file for ProxyGPT. This file contains the sliding window rate
+limiter used for the hourly and daily limits.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the shared SQLite backend
+import sqlite3
+import threading
+
+# Required for the in-memory backend and timestamps
+from collections import deque
+import math
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+
+# ------------- [Settings] -------------
+
+# Width of one counter bucket in seconds. Windows are rounded to whole buckets.
+BUCKET_SECONDS = 60
+
+
+# ------------- [Rate Limiters] -------------
+
+class RateLimiter:
+    """
+    Base class for the rate limiter engines.
+
+    A limiter is created with a mapping of window length in seconds to the
+    maximum number of calls allowed within that rolling window, and
+    optionally a mapping of window length to the maximum number of tokens.
+    Calls and tokens are counted in buckets of BUCKET_SECONDS, so the window
+    slides one bucket at a time instead of scanning individual calls.
+    """
+
+    def __init__(self, limits: Dict[int, int], token_limits: Optional[Dict[int, int]] = None):
+        self.limits = dict(limits)
+        self.token_limits = dict(token_limits or {})
+        # Windows to keep counters for, with a call limit, a token limit or both
+        self.windows = sorted(set(self.limits) | set(self.token_limits))
+
+    def acquire(self, amount: int = 1, tokens: int = 0, bucket: Optional[int] = None) -> bool:
+        """
+        Checks every window and, if all of them have room for amount more
+        calls and tokens more tokens, records them in bucket (the current
+        bucket by default). Both happen in one atomic step.
+
+        Returns:
+            bool: True if the calls were recorded, False if a limit was reached.
+        """
+        raise NotImplementedError
+
+    def adjust(self, amount: int = 0, tokens: int = 0, bucket: Optional[int] = None) -> None:
+        """
+        Adds calls and tokens to bucket (the current bucket by default)
+        without checking the limits, for example to settle a reservation
+        with the actual usage in the bucket it was recorded in. Negative
+        values refund (part of) a reservation. Windows the bucket has
+        already left are not changed.
+        """
+        raise NotImplementedError
+
+    def window_totals(self, window: int) -> Tuple[int, int]:
+        """
+        Returns the number of calls and tokens recorded within the last window seconds.
+        """
+        raise NotImplementedError
+
+    def usage(self, window: int) -> int:
+        """
+        Returns the number of calls recorded within the last window seconds.
+        """
+        return self.window_totals(window)[0]
+
+    def token_usage(self, window: int) -> int:
+        """
+        Returns the number of tokens recorded within the last window seconds.
+        """
+        return self.window_totals(window)[1]
+
+    def has_room(self, amount: int = 1, tokens: int = 0) -> bool:
+        """
+        Returns True if every window has room for amount more calls and tokens
+        more tokens right now, without recording anything. Reads the running
+        totals only, so it is cheap enough for every request.
+        """
+        return all(self._fits(window, *self.window_totals(window), amount, tokens) for window in self.windows)
+
+    def window_buckets(self, window: int) -> List[Tuple[int, int, int]]:
+        """
+        Returns the (bucket, calls, tokens) of the buckets within the last window seconds, oldest first.
+        """
+        raise NotImplementedError
+
+    def retry_after(self, amount: int = 1, tokens: int = 0) -> int:
+        """
+        Returns the number of seconds until amount more calls and tokens more
+        tokens fit within every window, computed from when the oldest buckets
+        slide out.
+        """
+        now = time.time()
+        wait = 0
+        # Column of the bucket tuples to sum, limit and requested amount
+        checks = [(1, window, limit, amount) for window, limit in self.limits.items()]
+        checks += [(2, window, limit, tokens) for window, limit in self.token_limits.items() if tokens > 0]
+        for column, window, limit, requested in checks:
+            buckets = self.window_buckets(window)
+            excess = sum(bucket[column] for bucket in buckets) + requested - limit
+            if excess <= 0:
+                continue
+            if requested > limit:
+                return window
+            for bucket in buckets:
+                excess -= bucket[column]
+                if excess <= 0:
+                    # The bucket leaves the window once a full window of buckets has passed
+                    wait = max(wait, (bucket[0] + window // BUCKET_SECONDS) * BUCKET_SECONDS - now)
+                    break
+        return max(0, int(math.ceil(wait)))
+
+    def _fits(self, window: int, calls: int, tokens: int, amount: int, requested_tokens: int) -> bool:
+        # Check the call and token limits of one window against its current totals
+        if window in self.limits and calls + amount > self.limits[window]:
+            return False
+        if window in self.token_limits and requested_tokens > 0 and tokens + requested_tokens > self.token_limits[window]:
+            return False
+        return True
+
+
+class MemoryRateLimiter(RateLimiter):
+    """
+    Rate limiter that keeps its counters in the memory of the current process.
+    Counters are not shared between gunicorn workers, so it is only suited to
+    running a single worker (for example with uvicorn during development).
+    """
+
+    def __init__(self, limits: Dict[int, int], token_limits: Optional[Dict[int, int]] = None):
+        super().__init__(limits, token_limits)
+        self._lock = threading.Lock()
+        # Per window: a queue of [bucket, calls, tokens] entries and the running totals
+        self._buckets = {window: deque() for window in self.windows}
+        self._totals = {window: [0, 0] for window in self.windows}
+
+    def _expire(self, window: int, bucket: int) -> None:
+        # Drop buckets that slid out of the window and subtract them from the totals
+        buckets = self._buckets.setdefault(window, deque())
+        totals = self._totals.setdefault(window, [0, 0])
+        oldest = bucket - window // BUCKET_SECONDS
+        while buckets and buckets[0][0] <= oldest:
+            _, calls, tokens = buckets.popleft()
+            totals[0] -= calls
+            totals[1] -= tokens
+
+    def _record(self, bucket: int, amount: int, tokens: int) -> None:
+        for window in self.windows:
+            buckets = self._buckets[window]
+            # The bucket is usually the newest one, or close to it when a reservation is settled
+            for entry in reversed(buckets):
+                if entry[0] <= bucket:
+                    break
+            else:
+                entry = None
+            if entry is not None and entry[0] == bucket:
+                entry[1] += amount
+                entry[2] += tokens
+            elif not buckets or buckets[-1][0] < bucket:
+                buckets.append([bucket, amount, tokens])
+            else:
+                # The bucket has already left this window
+                continue
+            self._totals[window][0] += amount
+            self._totals[window][1] += tokens
+
+    def acquire(self, amount: int = 1, tokens: int = 0, bucket: Optional[int] = None) -> bool:
+        now = current_bucket()
+        with self._lock:
+            for window in self.windows:
+                self._expire(window, now)
+                if not self._fits(window, *self._totals[window], amount, tokens):
+                    return False
+            self._record(now if bucket is None else bucket, amount, tokens)
+            return True
+
+    def adjust(self, amount: int = 0, tokens: int = 0, bucket: Optional[int] = None) -> None:
+        now = current_bucket()
+        with self._lock:
+            for window in self.windows:
+                self._expire(window, now)
+            self._record(now if bucket is None else bucket, amount, tokens)
+
+    def window_totals(self, window: int) -> Tuple[int, int]:
+        bucket = current_bucket()
+        with self._lock:
+            self._expire(window, bucket)
+            return tuple(self._totals[window])
+
+    def window_buckets(self, window: int) -> List[Tuple[int, int, int]]:
+        bucket = current_bucket()
+        with self._lock:
+            self._expire(window, bucket)
+            return [tuple(entry) for entry in self._buckets[window]]
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    Rate limiter that keeps pre-aggregated per-bucket counters in a single
+    SQLite database in WAL mode, shared by all gunicorn workers on the host.
+
+    Next to the buckets, a running total of calls and tokens is kept per
+    window. Each check reads the totals and subtracts the few buckets that
+    slid out of the window since the last check (each bucket leaves each
+    window once), so the work per call does not grow with the length of the
+    window. Buckets that left every window are pruned.
+    """
+
+    def __init__(self, limits: Dict[int, int], path: str = "proxygpt.db", token_limits: Optional[Dict[int, int]] = None):
+        super().__init__(limits, token_limits)
+        self.path = path
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS api_usage_buckets
+                            (bucket integer PRIMARY KEY, calls integer NOT NULL, tokens integer NOT NULL DEFAULT 0)''')
+            # Databases created before token accounting lack the tokens column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(api_usage_buckets)")]
+            if "tokens" not in columns:
+                conn.execute("ALTER TABLE api_usage_buckets ADD COLUMN tokens integer NOT NULL DEFAULT 0")
+            self._migrate_legacy_table(conn)
+            self._init_totals(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, so one is kept per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _migrate_legacy_table(self, conn: sqlite3.Connection) -> None:
+        # Earlier versions kept one row per call in api_usage. Its calls within
+        # the longest window are moved into the buckets, then the table is dropped.
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'api_usage'").fetchone() is None:
+            return
+        if self.windows:
+            conn.execute('''INSERT INTO api_usage_buckets (bucket, calls)
+                            SELECT api_timestamp / ?, COUNT(*) FROM api_usage WHERE api_timestamp > ? GROUP BY 1
+                            ON CONFLICT(bucket) DO UPDATE SET calls = calls + excluded.calls''',
+                         (BUCKET_SECONDS, int(time.time()) - max(self.windows)))
+        conn.execute("DROP TABLE api_usage")
+
+    def _init_totals(self, conn: sqlite3.Connection) -> None:
+        # One row per window: the totals of the buckets after expired_through.
+        # Windows that are new are summed up once, windows no longer used are removed.
+        conn.execute('''CREATE TABLE IF NOT EXISTS api_usage_totals
+                        (window_seconds integer PRIMARY KEY, calls integer NOT NULL,
+                         tokens integer NOT NULL, expired_through integer NOT NULL)''')
+        conn.execute(f"DELETE FROM api_usage_totals WHERE window_seconds NOT IN ({','.join('?' * len(self.windows))})",
+                     self.windows)
+        bucket = current_bucket()
+        for window in self.windows:
+            expired_through = bucket - window // BUCKET_SECONDS
+            conn.execute('''INSERT OR IGNORE INTO api_usage_totals
+                            SELECT ?, COALESCE(SUM(calls), 0), COALESCE(SUM(tokens), 0), ?
+                            FROM api_usage_buckets WHERE bucket > ?''',
+                         (window, expired_through, expired_through))
+
+    def _expire(self, conn: sqlite3.Connection, bucket: int) -> Dict[int, Tuple[int, int]]:
+        # Subtract the buckets that left each window from its totals, and return the totals.
+        # Must run within a write transaction.
+        totals = {}
+        advanced = False
+        for window, calls, tokens, expired_through in conn.execute(
+                "SELECT window_seconds, calls, tokens, expired_through FROM api_usage_totals").fetchall():
+            cutoff = bucket - window // BUCKET_SECONDS
+            if cutoff > expired_through:
+                advanced = True
+                expired_calls, expired_tokens = conn.execute(
+                    '''SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(tokens), 0) FROM api_usage_buckets
+                       WHERE bucket > ? AND bucket <= ?''', (expired_through, cutoff)).fetchone()
+                calls -= expired_calls
+                tokens -= expired_tokens
+                conn.execute("UPDATE api_usage_totals SET calls = ?, tokens = ?, expired_through = ? WHERE window_seconds = ?",
+                             (calls, tokens, cutoff, window))
+            totals[window] = (calls, tokens)
+        # Buckets that left every window are no longer needed
+        if advanced:
+            conn.execute("DELETE FROM api_usage_buckets WHERE bucket <= (SELECT MIN(expired_through) FROM api_usage_totals)")
+        return totals
+
+    def _record(self, conn: sqlite3.Connection, bucket: int, amount: int, tokens: int) -> None:
+        conn.execute('''INSERT INTO api_usage_buckets VALUES (?, ?, ?)
+                        ON CONFLICT(bucket) DO UPDATE SET calls = calls + excluded.calls, tokens = tokens + excluded.tokens''',
+                     (bucket, amount, tokens))
+        # Only the windows the bucket has not left yet count it
+        conn.execute("UPDATE api_usage_totals SET calls = calls + ?, tokens = tokens + ? WHERE expired_through < ?",
+                     (amount, tokens, bucket))
+
+    def window_totals(self, window: int) -> Tuple[int, int]:
+        # Read without the write lock: the totals minus the buckets that left the window since the last check
+        bucket = current_bucket()
+        conn = self._connection()
+        row = conn.execute("SELECT calls, tokens, expired_through FROM api_usage_totals WHERE window_seconds = ?",
+                           (window,)).fetchone()
+        if row is None:
+            return 0, 0
+        calls, tokens, expired_through = row
+        expired_calls, expired_tokens = conn.execute(
+            '''SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(tokens), 0) FROM api_usage_buckets
+               WHERE bucket > ? AND bucket <= ?''', (expired_through, bucket - window // BUCKET_SECONDS)).fetchone()
+        return calls - expired_calls, tokens - expired_tokens
+
+    def acquire(self, amount: int = 1, tokens: int = 0, bucket: Optional[int] = None) -> bool:
+        now = current_bucket()
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so no other worker can
+        # record calls between the check and the increment.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            totals = self._expire(conn, now)
+            for window in self.windows:
+                if not self._fits(window, *totals[window], amount, tokens):
+                    conn.execute("COMMIT")
+                    return False
+            self._record(conn, now if bucket is None else bucket, amount, tokens)
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def adjust(self, amount: int = 0, tokens: int = 0, bucket: Optional[int] = None) -> None:
+        now = current_bucket()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._expire(conn, now)
+            self._record(conn, now if bucket is None else bucket, amount, tokens)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def window_buckets(self, window: int) -> List[Tuple[int, int, int]]:
+        bucket = current_bucket()
+        c = self._connection().execute("SELECT bucket, calls, tokens FROM api_usage_buckets WHERE bucket > ? ORDER BY bucket",
+                                       (bucket - window // BUCKET_SECONDS,))
+        return c.fetchall()
+
+
+# ------------- [Functions] -------------
+
+# Make function for getting the current bucket
+def current_bucket() -> int:
+    """
+    This function returns the number of the bucket of the current time.
+    """
+    return int(time.time()) // BUCKET_SECONDS
+
+# Make function for creating the configured rate limiter
+def create_rate_limiter(backend: str, limits: Dict[int, int], path: str = "proxygpt.db",
+                        token_limits: Optional[Dict[int, int]] = None) -> RateLimiter:
+    """
+    This function creates the rate limiter engine selected in settings.py.
+
+    Args:
+        backend (str): "sqlite" to share counters across workers, or "memory".
+        limits (dict): Maximum calls per rolling window, keyed by window length in seconds.
+        path (str): Database file used by the SQLite backend.
+        token_limits (dict): Maximum tokens per rolling window, keyed by window length in seconds.
+    """
+    if backend == "sqlite":
+        return SQLiteRateLimiter(limits, path, token_limits)
+    if backend == "memory":
+        return MemoryRateLimiter(limits, token_limits)
+    raise ValueError(f"Unknown rate limiter backend: {backend}")
@@ -0,0 +1,341 @@
+"""
+Resilience.py file for ProxyGPT. This file contains the hedged requests,
+retries and circuit breaker around the OpenAI completion call.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for racing and retrying upstream calls
+import asyncio
+from collections import deque
+import math
+import random
+import time
+
+# Required for telling transient errors apart
+import aiohttp
+import openai
+
+from typing import Callable, Dict, Optional
+
+# Required for the hedge, retry and breaker metrics
+from metrics import UPSTREAM_HEDGES, UPSTREAM_RETRIES, UPSTREAM_FALLBACKS, CIRCUIT_BREAKER_STATE
+
+# Import upstream client settings
+from settings import UPSTREAM_CONNECT_TIMEOUT
+
+
+# ------------- [Functions] -------------
+
+# Make function for telling transient upstream errors apart
+def is_transient_error(e: Exception) -> bool:
+    """
+    This function returns True if a failed upstream call may succeed when
+    retried: timeouts, connection errors, 429 and 5xx responses.
+    """
+    if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                      openai.error.ServiceUnavailableError, openai.error.TryAgain,
+                      asyncio.TimeoutError, aiohttp.ClientError)):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return False
+
+
+# ------------- [Classes] -------------
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when no upstream call succeeded within the deadline of the request.
+    """
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent successful calls, for percentiles.
+    """
+
+    def __init__(self, max_samples: int = 200):
+        self._samples = deque(maxlen=max_samples)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Returns the p-th percentile (0 to 1) of the recent latencies, or None without samples.
+        """
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, math.ceil(p * len(samples)) - 1)]
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one model. After failure_threshold consecutive
+    failures the breaker opens, and calls go to the fallback model. After
+    reset_timeout seconds one probe call is let through (half open). The
+    breaker closes if it succeeds, and opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    # Values of the breaker state gauge
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        CIRCUIT_BREAKER_STATE.labels(self.name).set(self.STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """
+        Returns True if a call may be sent to the model now.
+        """
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        return self.state == self.CLOSED
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.probing = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_abandoned(self) -> None:
+        # A probe that was cancelled tells nothing, so the next call may probe
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self._set_state(self.OPEN)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+        }
+
+
+class ResilientCompleter:
+    """
+    Calls a completion function with hedging, retries and failover.
+
+    - Hedging: if a call has not finished after the hedge_percentile latency
+      of recent calls to the model, a second identical call is sent, and the
+      first to succeed wins. The other one is cancelled.
+    - Retries: calls that fail with a transient error are retried with
+      jittered exponential backoff, as long as the deadline allows.
+    - Circuit breaker: while the primary model keeps failing, calls go to the
+      fallback model instead.
+
+    Every extra upstream call (hedge or retry) is charged with charge(), and
+    is not sent if it returns False. The first call must be charged by the
+    caller.
+    """
+
+    def __init__(self, create: Callable, model: str, fallback_model: Optional[str] = None,
+                 charge: Optional[Callable[[], bool]] = None, deadline: float = 90,
+                 max_attempts: int = 3, backoff: float = 0.5, max_backoff: float = 8,
+                 use_hedging: bool = True, hedge_percentile: float = 0.95, hedge_min_samples: int = 20,
+                 hedge_min_delay: float = 2, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.create = create
+        self.model = model
+        self.fallback_model = fallback_model
+        self.charge = charge or (lambda: True)
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.use_hedging = use_hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = CircuitBreaker(model, failure_threshold, reset_timeout)
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self.counters = {
+            "calls": 0,
+            "hedges_sent": 0,
+            "hedge_wins": 0,
+            "hedges_not_charged": 0,
+            "retries": 0,
+            "retries_not_charged": 0,
+            "fallbacks": 0,
+            "deadline_exceeded": 0,
+        }
+
+    def choose_model(self) -> str:
+        """
+        Returns the model to call: the primary model, or the fallback model while the breaker is open.
+        """
+        if self.fallback_model is None or self.breaker.allow():
+            return self.model
+        self.counters["fallbacks"] += 1
+        UPSTREAM_FALLBACKS.inc()
+        return self.fallback_model
+
+    def record_outcome(self, model: str, error: Optional[Exception] = None) -> None:
+        """
+        Records the outcome of a call to model in the circuit breaker. Only
+        calls to the primary model count. Transient errors are failures, and
+        other errors (such as an invalid request) count as successes, since
+        the model did answer. Cancelled calls free the probe of a half open
+        breaker. Every outcome frees the probe.
+        """
+        if model != self.model:
+            return
+        if isinstance(error, asyncio.CancelledError):
+            self.breaker.record_abandoned()
+        elif error is not None and is_transient_error(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        """
+        Returns the seconds after which a call to model is hedged, or None if
+        there are too few recent calls to tell what is slow.
+        """
+        tracker = self.latencies.get(model)
+        if not self.use_hedging or tracker is None or len(tracker) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    async def complete(self, charge: Optional[Callable[[], bool]] = None, **kwargs) -> tuple:
+        """
+        Creates a completion, passing kwargs (without model) to the completion function.
+        Extra calls are charged with charge if given, otherwise with the charge of the completer.
+
+        Returns:
+            tuple: The response and the model that answered.
+
+        Raises:
+            DeadlineExceeded: If no call succeeded within the deadline.
+            Exception: The error of the last call, if it was not transient or no retry was left.
+        """
+        self.counters["calls"] += 1
+        charge = charge or self.charge
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            model = self.choose_model()
+            try:
+                return await self._hedged_call(model, deadline, kwargs, charge), model
+            except DeadlineExceeded:
+                self.counters["deadline_exceeded"] += 1
+                raise
+            except Exception as e:
+                attempt += 1
+                if not is_transient_error(e) or attempt >= self.max_attempts:
+                    raise
+                # Full jitter, so retries of concurrent requests spread out
+                backoff = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+                if time.monotonic() + backoff >= deadline:
+                    raise
+                if not charge():
+                    self.counters["retries_not_charged"] += 1
+                    raise
+                self.counters["retries"] += 1
+                UPSTREAM_RETRIES.labels(type(e).__name__).inc()
+                await asyncio.sleep(backoff)
+
+    async def _call(self, model: str, deadline: float, kwargs: dict):
+        start = time.monotonic()
+        try:
+            # The upstream timeout never runs past the deadline of the request
+            response = await self.create(model=model,
+                                         request_timeout=(UPSTREAM_CONNECT_TIMEOUT, max(deadline - start, 0.1)),
+                                         **kwargs)
+        except (Exception, asyncio.CancelledError) as e:
+            self.record_outcome(model, e)
+            raise
+        self.record_outcome(model)
+        self.latencies.setdefault(model, LatencyTracker()).record(time.monotonic() - start)
+        return response
+
+    async def _hedged_call(self, model: str, deadline: float, kwargs: dict, charge: Callable[[], bool]):
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._call(model, deadline, kwargs))
+        hedge = None
+        pending = {primary}
+        # Seconds after which to hedge, None once hedged or if there is no hedge
+        delay = self.hedge_delay(model)
+        error = None
+        try:
+            while pending:
+                timeout = deadline - time.monotonic()
+                if delay is not None:
+                    timeout = min(timeout, started + delay - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters["hedge_wins"] += 1
+                            UPSTREAM_HEDGES.labels("won").inc()
+                        return task.result()
+                    error = task.exception()
+                if done:
+                    continue
+                if time.monotonic() >= deadline:
+                    self.record_outcome(model, asyncio.TimeoutError())
+                    raise DeadlineExceeded(f"No completion within {self.deadline} seconds.")
+                # The call is slower than usual, so race it against a second one
+                delay = None
+                if charge():
+                    hedge = asyncio.ensure_future(self._call(model, deadline, kwargs))
+                    pending.add(hedge)
+                    self.counters["hedges_sent"] += 1
+                    UPSTREAM_HEDGES.labels("sent").inc()
+                else:
+                    self.counters["hedges_not_charged"] += 1
+                    UPSTREAM_HEDGES.labels("not_charged").inc()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Returns the hedge, retry and fallback counts, the breaker state and
+        the recent latency percentiles per model.
+        """
+        stats = dict(self.counters)
+        stats["model"] = self.model
+        stats["fallback_model"] = self.fallback_model
+        stats["breaker"] = self.breaker.stats()
+        stats["latency"] = {
+            model: {"samples": len(tracker), "p50": tracker.percentile(0.5), "p95": tracker.percentile(0.95)}
+            for model, tracker in self.latencies.items()
+        }
+        stats["hedge_delay"] = {model: self.hedge_delay(model) for model in self.latencies}
+        return stats
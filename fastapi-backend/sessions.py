@@ -0,0 +1,304 @@
+"""
+Sessions.py file for ProxyGPT. This file contains the store of conversation
+histories used by the session-aware coaching endpoint.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the shared store
+import sqlite3
+import threading
+
+# Required for compact records and expiry
+import json
+import time
+
+from typing import List, Optional
+
+# Required for estimating the size of the history in tokens
+from knowledge import estimate_tokens
+
+# Required for the store size and eviction metrics
+from metrics import SESSION_STORE_SIZE, SESSION_EVICTIONS
+
+
+# ------------- [Settings] -------------
+
+# Characters of a turn kept in the summary of older turns
+SUMMARY_LINE_CHARS = 200
+
+# Seconds between removals of idle sessions
+PRUNE_INTERVAL = 60
+
+# Compact role names used in stored records
+ROLE_CODES = {"user": "u", "assistant": "a"}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+
+# ------------- [Functions] -------------
+
+# Make function for shortening a coaching response to keep in the history
+def compact_response(content: str) -> str:
+    """
+    This function returns the part of a coaching response worth keeping in
+    the history: the response to the user and the titles of the skills.
+    Responses that are not valid JSON are kept as they are.
+    """
+    try:
+        data = json.loads(content)
+        skills = [skill.get("skill-brief-title", "") for skill in data.get("skill-specific-responses", [])]
+        compact = data.get("response_to_user", "")
+    except (ValueError, AttributeError):
+        return content
+    if any(skills):
+        compact += "\nSkills applied: " + "; ".join(skill for skill in skills if skill)
+    return compact
+
+
+# ------------- [Classes] -------------
+
+class Turn:
+    """
+    One message of a conversation, with its estimated tokens.
+    """
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        self.tokens = estimate_tokens(content)
+
+
+class Session:
+    """
+    A conversation: a summary of the older turns and the recent turns.
+    """
+
+    __slots__ = ("session_id", "summary", "turns")
+
+    def __init__(self, session_id: str, summary: str = "", turns: Optional[List[Turn]] = None):
+        self.session_id = session_id
+        self.summary = summary
+        self.turns = turns if turns is not None else []
+
+    def to_record(self) -> str:
+        return json.dumps([self.summary, [[ROLE_CODES[turn.role], turn.content] for turn in self.turns]],
+                          separators=(",", ":"), ensure_ascii=False)
+
+    @classmethod
+    def from_record(cls, session_id: str, record: str) -> "Session":
+        summary, turns = json.loads(record)
+        return cls(session_id, summary, [Turn(ROLE_NAMES[code], content) for code, content in turns])
+
+
+class SessionStore:
+    """
+    Conversation histories in a SQLite database in WAL mode, shared by all
+    gunicorn workers on the host.
+
+    Each session is one compact record. When the recent turns of a session
+    exceed history_tokens, the oldest turns are folded into a short
+    extractive summary of at most summary_tokens, so the history sent to
+    OpenAI stays within a fixed budget. Sessions that were not used for ttl
+    seconds are removed, and the least recently used sessions are evicted
+    when all records together exceed max_bytes. Reading or writing a session
+    makes it the most recently used. The number and size of the records are
+    kept as running totals, updated in the same transaction as the records,
+    so the bound is checked without scanning the table.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: int, history_tokens: int, summary_tokens: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self._local = threading.local()
+        self._last_pruned = 0.0
+        self.counters = {"evicted_lru": 0, "expired": 0, "folded_turns": 0}
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS chat_sessions
+                            (session_id text PRIMARY KEY, record text NOT NULL,
+                             size integer NOT NULL, last_access real NOT NULL)''')
+            conn.execute("CREATE INDEX IF NOT EXISTS chat_sessions_last_access ON chat_sessions (last_access)")
+            # One row with the number and total size of all records, summed up once when the table is new
+            conn.execute('''CREATE TABLE IF NOT EXISTS chat_sessions_totals
+                            (id integer PRIMARY KEY CHECK (id = 0), sessions integer NOT NULL, bytes integer NOT NULL)''')
+            conn.execute('''INSERT OR IGNORE INTO chat_sessions_totals
+                            SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM chat_sessions''')
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads, so one is kept per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """
+        Returns the session, or None if it does not exist or has expired. The
+        session becomes the most recently used, so it is not evicted while in use.
+        """
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT record FROM chat_sessions WHERE session_id = ? AND last_access >= ?",
+                           (session_id, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE chat_sessions SET last_access = ? WHERE session_id = ? AND last_access < ?",
+                     (now, session_id, now))
+        return Session.from_record(session_id, row[0])
+
+    def append(self, session_id: str, turns: List[Turn]) -> Session:
+        """
+        Adds turns to a session, creating it if needed, and returns the stored session.
+        """
+        now = time.time()
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so turns appended by
+        # another worker at the same time are not lost.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT record, size, last_access FROM chat_sessions WHERE session_id = ?",
+                               (session_id,)).fetchone()
+            # An expired record is replaced by a new session
+            session = Session.from_record(session_id, row[0]) if row and row[2] >= now - self.ttl else Session(session_id)
+            session.turns.extend(turns)
+            self._fold(session)
+            record = session.to_record()
+            size = len(record.encode("utf-8"))
+            conn.execute('''INSERT INTO chat_sessions VALUES (?, ?, ?, ?)
+                            ON CONFLICT(session_id) DO UPDATE SET
+                            record = excluded.record, size = excluded.size, last_access = excluded.last_access''',
+                         (session_id, record, size, now))
+            self._add_totals(conn, 0 if row else 1, size - (row[1] if row else 0))
+            self._evict(conn, now, session_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        """
+        Removes a session. Returns True if it existed.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT size FROM chat_sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+                self._add_totals(conn, -1, -row[0])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row is not None
+
+    def _add_totals(self, conn: sqlite3.Connection, sessions: int, size: int) -> None:
+        conn.execute("UPDATE chat_sessions_totals SET sessions = sessions + ?, bytes = bytes + ? WHERE id = 0",
+                     (sessions, size))
+
+    def _fold(self, session: Session) -> None:
+        # Fold the oldest turns into the summary until the recent turns fit the budget.
+        # The last exchange is always kept whole.
+        while len(session.turns) > 2 and sum(turn.tokens for turn in session.turns) > self.history_tokens:
+            turn = session.turns.pop(0)
+            text = " ".join(turn.content.split())
+            if len(text) > SUMMARY_LINE_CHARS:
+                text = text[:SUMMARY_LINE_CHARS - 1] + "…"
+            prefix = "User: " if turn.role == "user" else "Coach: "
+            session.summary = (session.summary + "\n" if session.summary else "") + prefix + text
+            self.counters["folded_turns"] += 1
+        # The oldest lines of the summary go first
+        lines = session.summary.split("\n") if session.summary else []
+        while lines and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        session.summary = "\n".join(lines)
+
+    def _evict(self, conn: sqlite3.Connection, now: float, keep: str) -> None:
+        if now - self._last_pruned >= PRUNE_INTERVAL:
+            # Only the expired rows are read, through the last_access index
+            expired, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chat_sessions WHERE last_access < ?",
+                                         (now - self.ttl,)).fetchone()
+            if expired:
+                conn.execute("DELETE FROM chat_sessions WHERE last_access < ?", (now - self.ttl,))
+                self._add_totals(conn, -expired, -size)
+            self.counters["expired"] += expired
+            SESSION_EVICTIONS.labels("expired").inc(expired)
+            self._last_pruned = now
+        sessions, total = conn.execute("SELECT sessions, bytes FROM chat_sessions_totals WHERE id = 0").fetchone()
+        if total > self.max_bytes:
+            total_before = total
+            evicted = []
+            for session_id, size in conn.execute('''SELECT session_id, size FROM chat_sessions
+                                                    WHERE session_id != ? ORDER BY last_access''', (keep,)):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((session_id,))
+                total -= size
+            conn.executemany("DELETE FROM chat_sessions WHERE session_id = ?", evicted)
+            sessions -= len(evicted)
+            self._add_totals(conn, -len(evicted), total - total_before)
+            self.counters["evicted_lru"] += len(evicted)
+            SESSION_EVICTIONS.labels("lru").inc(len(evicted))
+        SESSION_STORE_SIZE.labels("sessions").set(sessions)
+        SESSION_STORE_SIZE.labels("bytes").set(total)
+
+    def build_history(self, session: Optional[Session]) -> list:
+        """
+        Returns the chat messages of the history of a session: the summary of
+        the older turns, then the recent turns.
+        """
+        if session is None:
+            return []
+        messages = []
+        if session.summary:
+            messages.append({"role": "system", "content": "Summary of the earlier conversation:\n" + session.summary})
+        # Older turns are folded when stored, so normally all recent turns fit. A
+        # single exchange that is longer than the budget is cut short.
+        recent = []
+        budget = self.history_tokens
+        for turn in reversed(session.turns):
+            if budget <= 0:
+                break
+            content = turn.content
+            if turn.tokens > budget:
+                content = content[:budget * 4] + "…"
+            recent.append({"role": turn.role, "content": content})
+            budget -= turn.tokens
+        messages.extend(reversed(recent))
+        return messages
+
+    def stats(self) -> dict:
+        """
+        Returns the number and size of the stored sessions, and the evictions seen by this worker.
+        """
+        c = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chat_sessions WHERE last_access >= ?",
+                                       (time.time() - self.ttl,))
+        sessions, size = c.fetchone()
+        stats = dict(self.counters)
+        stats.update({
+            "sessions": sessions,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "history_tokens": self.history_tokens,
+            "summary_tokens": self.summary_tokens,
+        })
+        return stats
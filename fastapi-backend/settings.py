@@ -21,3 +21,173 @@ exposing any secret variables stored on the server side to client.
 """
 INSECURE_DEBUG = False
 
+# Log level of the application. Set to "DEBUG" for verbose logs.
+LOG_LEVEL = "INFO"
+
+
+# ------------- [Settings: Upstream] -------------
+
+"""
+Settings for the pooled HTTP client used to call OpenAI. Each worker keeps one
+shared session, so a single worker can carry many completions at once.
+"""
+UPSTREAM_POOL_SIZE = 100 # Max simultaneous connections to OpenAI per worker
+UPSTREAM_KEEPALIVE_TIMEOUT = 30 # Seconds an idle connection is kept open for reuse
+UPSTREAM_CONNECT_TIMEOUT = 10 # Seconds allowed to open a connection to OpenAI
+UPSTREAM_READ_TIMEOUT = 120 # Seconds allowed without data from OpenAI, before a non-streamed completion arrives or between stream chunks
+POOL_EJECT_TIME = 10 # Seconds a throttled key of OPENAI_API_POOL is skipped, doubled per 429 in a row
+POOL_MAX_EJECT_TIME = 300 # Max seconds a key is skipped, also used for rejected keys
+
+# ------------- [Settings: Rate Limiter] -------------
+
+"""
+Set RATE_LIMIT_BACKEND to "sqlite" to share the hourly and daily counters
+between all gunicorn workers through one WAL-mode database file, or to
+"memory" to keep them inside a single worker process (development only).
+The hourly and daily token budgets are kept in the same database.
+"""
+RATE_LIMIT_BACKEND = "sqlite"
+RATE_LIMIT_DB_PATH = "proxygpt.db" # Database file used by the sqlite backend
+
+# ------------- [Settings: Completion] -------------
+
+# Model and sampling parameters of coaching completions
+JOYCOACH_MODEL = "gpt-4"
+JOYCOACH_COMPLETION_PARAMS = {
+    "temperature": 0.2,
+    "max_tokens": 3000,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+}
+
+# ------------- [Settings: Token Accounting] -------------
+
+"""
+Prompt tokens are counted locally before each call, and max_tokens is chosen
+per request. With USE_ADAPTIVE_MAX_TOKENS, once MAX_TOKENS_MIN_SAMPLES
+completions have been seen, max_tokens is the MAX_TOKENS_PERCENTILE of recent
+completion lengths times MAX_TOKENS_HEADROOM, between MAX_TOKENS_FLOOR and the
+max_tokens of JOYCOACH_COMPLETION_PARAMS. It never exceeds what is left of
+JOYCOACH_CONTEXT_WINDOW after the prompt. The prompt and max_tokens are
+reserved against the hourly and daily token budgets, and replaced by the
+actual usage once the completion has finished.
+"""
+USE_ADAPTIVE_MAX_TOKENS = True
+MAX_TOKENS_FLOOR = 500
+MAX_TOKENS_PERCENTILE = 0.99
+MAX_TOKENS_HEADROOM = 1.5
+MAX_TOKENS_MIN_SAMPLES = 20 # Recent completions needed before adapting
+JOYCOACH_CONTEXT_WINDOW = 8192 # Tokens of prompt and completion together
+
+# ------------- [Settings: Completion Cache] -------------
+
+"""
+Set USE_COMPLETION_CACHE to False to disable the completion cache. Cached
+completions are returned without calling OpenAI and do not count against
+the hourly or daily rate limits.
+"""
+USE_COMPLETION_CACHE = True
+CACHE_MAX_ENTRIES = 1000 # Max completions kept in memory per worker
+CACHE_TTL = 86400 # Seconds a cached completion stays valid
+CACHE_DB_PATH = "joycoach_cache.db" # Database file of the on-disk tier shared by all workers (None to disable)
+CACHE_DISK_MAX_ENTRIES = 100000 # Max completions kept in the on-disk tier, the first to expire are evicted (None for no cap)
+
+# ------------- [Settings: Request Coalescing] -------------
+
+"""
+Identical coaching requests that arrive while the first one is still being
+answered share its OpenAI call. Set USE_CROSS_WORKER_COALESCING to True to
+also share calls between gunicorn workers through leases in COALESCE_DB_PATH.
+Coalescing across workers needs the completion cache, which is where the
+waiting workers pick up the result.
+"""
+USE_CROSS_WORKER_COALESCING = True
+COALESCE_DB_PATH = "joycoach_leases.db" # Database file of the cross-worker leases
+COALESCE_LEASE_TTL = 180 # Seconds before a lease of a crashed worker is taken over
+COALESCE_POLL_INTERVAL = 0.25 # Seconds between checks for the result of another worker
+
+# ------------- [Settings: Knowledge] -------------
+
+"""
+Set KNOWLEDGE_PROMPT_MODE to "retrieval" to build the system prompt from only
+the book notes in KNOWLEDGE_DIR that are most relevant to the user's situation,
+or to "full" to send the complete hardcoded book notes with every request.
+"""
+KNOWLEDGE_PROMPT_MODE = "retrieval"
+KNOWLEDGE_DIR = "knowledge" # Directory of the book notes, relative to main.py
+KNOWLEDGE_TOP_K = 6 # Max chunks of book notes per request
+KNOWLEDGE_TOKEN_BUDGET = 1200 # Max estimated tokens of book notes per request
+KNOWLEDGE_CHUNK_TOKENS = 200 # Target size of a chunk in estimated tokens
+KNOWLEDGE_RELOAD_INTERVAL = 5 # Seconds between checks for changed knowledge files
+
+# ------------- [Settings: Batch] -------------
+
+# Settings of the batch coaching endpoint
+BATCH_MAX_MESSAGES = 1000 # Max messages per batch request
+BATCH_CONCURRENCY = 16 # Max OpenAI calls in flight per batch request
+
+# ------------- [Settings: Admission Control] -------------
+
+"""
+At most ADMISSION_MAX_INFLIGHT requests per worker call OpenAI at once. Other
+requests wait in a queue of at most ADMISSION_MAX_QUEUE entries. Requests that
+can not be served within ADMISSION_DEADLINE seconds are shed early with status
+code 503 and a Retry-After header.
+"""
+ADMISSION_MAX_INFLIGHT = 32
+ADMISSION_MAX_QUEUE = 64
+ADMISSION_DEADLINE = 30
+
+# ------------- [Settings: Resilience] -------------
+
+"""
+Each coaching completion must succeed within UPSTREAM_DEADLINE seconds, over
+at most UPSTREAM_MAX_ATTEMPTS attempts. Timeouts, connection errors, 429 and
+5xx responses are retried with jittered exponential backoff. With USE_HEDGING,
+a call that is slower than the HEDGE_PERCENTILE latency of recent calls is
+raced against a second call. After BREAKER_FAILURE_THRESHOLD failures in a row,
+calls go to JOYCOACH_FALLBACK_MODEL (None to disable) for BREAKER_RESET_TIMEOUT
+seconds before GPT-4 is tried again. Retries and hedges count against the
+hourly and daily rate limits, and are skipped if the limits are reached.
+"""
+UPSTREAM_DEADLINE = 90 # Seconds per coaching completion, including retries and hedges
+UPSTREAM_MAX_ATTEMPTS = 3
+UPSTREAM_RETRY_BACKOFF = 0.5 # Seconds, doubled per attempt
+UPSTREAM_RETRY_MAX_BACKOFF = 8 # Seconds
+USE_HEDGING = True
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20 # Recent calls needed before hedging
+HEDGE_MIN_DELAY = 2 # Seconds before the earliest hedge
+JOYCOACH_FALLBACK_MODEL = "gpt-3.5-turbo-16k" # Needs a context window as large as JOYCOACH_CONTEXT_WINDOW
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30 # Seconds
+
+# ------------- [Settings: Sessions] -------------
+
+"""
+The session endpoint keeps the conversation of each session in SESSION_DB_PATH,
+shared by all workers. Recent turns are sent with every request up to
+SESSION_HISTORY_TOKENS, older turns are folded into a summary of at most
+SESSION_SUMMARY_TOKENS. Sessions idle for SESSION_TTL seconds are removed, and
+the least recently used sessions are evicted beyond SESSION_MAX_BYTES.
+"""
+SESSION_DB_PATH = "joycoach_sessions.db"
+SESSION_MAX_BYTES = 50_000_000 # Max size of all stored sessions together
+SESSION_TTL = 86400 # Seconds
+SESSION_HISTORY_TOKENS = 1000 # Max estimated tokens of recent turns per request
+SESSION_SUMMARY_TOKENS = 300 # Max estimated tokens of the summary of older turns
+
+# ------------- [Settings: Discord Webhook] -------------
+
+"""
+Discord notifications are sent in the background. Notifications arriving within
+WEBHOOK_FLUSH_INTERVAL seconds are sent together in one message. When the queue
+of WEBHOOK_QUEUE_SIZE notifications is full, or Discord keeps failing, they are
+appended to WEBHOOK_SPILL_PATH and sent on the next start (None drops them).
+"""
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_FLUSH_INTERVAL = 2.0 # Seconds
+WEBHOOK_MAX_RETRIES = 5
+WEBHOOK_SPILL_PATH = "discord_spill.jsonl"
+WEBHOOK_SHUTDOWN_TIMEOUT = 10 # Seconds to send queued notifications on shutdown
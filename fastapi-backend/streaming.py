@@ -0,0 +1,114 @@
+"""
+Streaming.py file for ProxyGPT. This file contains the helpers used to stream
+coaching responses as Server-Sent Events.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for parsing and serializing events
+import json
+
+from typing import List, Tuple
+
+
+# ------------- [Functions] -------------
+
+# Make function for formatting a Server-Sent Event
+def format_sse(event: str, data: dict) -> str:
+    """
+    This function returns one Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# ------------- [Classes] -------------
+
+class CoachingStreamParser:
+    """
+    Incremental parser for the JSON format of the coaching response:
+
+        {"response_to_user": "...", "skill-specific-responses": [{...}, {...}]}
+
+    Text is fed in as it arrives from OpenAI. The parser tracks strings and
+    nesting depth character by character, so every value is scanned once,
+    and reports each top-level response and each skill entry as soon as its
+    closing quote or brace arrives. Text before the first brace (such as a
+    code fence) is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.skill_count = 0
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key = None
+        self._value_start = None
+
+    def feed(self, text: str) -> List[Tuple[str, dict]]:
+        """
+        Adds text to the parser.
+
+        Returns:
+            list: (event, data) pairs completed by the text.
+        """
+        self.buffer += text
+        events = []
+        while self._pos < len(self.buffer):
+            char = self.buffer[self._pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._end_string(events)
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 3 and self._key == "skill-specific-responses" and char == "{":
+                    self._value_start = self._pos
+                if self._depth == 1:
+                    self._expect_key = True
+            elif char in "}]":
+                if self._depth == 3 and self._value_start is not None and char == "}":
+                    self._end_skill(events)
+                self._depth -= 1
+            elif self._depth == 1 and char == ",":
+                self._expect_key = True
+            elif self._depth == 1 and char == ":":
+                self._expect_key = False
+            self._pos += 1
+        return events
+
+    def _end_string(self, events: list) -> None:
+        # Only strings directly inside the top-level object are keys or response values
+        if self._depth != 1:
+            return
+        try:
+            value = json.loads(self.buffer[self._string_start:self._pos + 1])
+        except ValueError:
+            return
+        if self._expect_key:
+            self._key = value
+        elif self._key == "response_to_user":
+            events.append(("response", {"response_to_user": value}))
+
+    def _end_skill(self, events: list) -> None:
+        try:
+            skill = json.loads(self.buffer[self._value_start:self._pos + 1])
+        except ValueError:
+            skill = None
+        self._value_start = None
+        if isinstance(skill, dict):
+            events.append(("skill", {"index": self.skill_count, "skill": skill}))
+            self.skill_count += 1
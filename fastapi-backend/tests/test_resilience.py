@@ -0,0 +1,64 @@
+import asyncio
+
+import openai
+import pytest
+
+from resilience import CircuitBreaker, ResilientCompleter
+
+
+def make_completer(errors):
+    """
+    Returns a completer whose primary model raises the given errors in turn,
+    and answers once they run out. The fallback model always answers.
+    """
+    calls = []
+
+    async def create(model, **kwargs):
+        calls.append(model)
+        if model == "primary" and errors:
+            raise errors.pop(0)
+        return {"model": model}
+
+    completer = ResilientCompleter(create, "primary", "fallback", max_attempts=1,
+                                   use_hedging=False, failure_threshold=1, reset_timeout=0)
+    return completer, calls
+
+
+def complete(completer):
+    return asyncio.run(completer.complete(messages=[]))
+
+
+def test_transient_failure_opens_breaker():
+    completer, _ = make_completer([openai.error.ServiceUnavailableError("down")])
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        complete(completer)
+    assert completer.breaker.state == CircuitBreaker.OPEN
+    assert completer.breaker.probing is False
+
+
+def test_non_transient_error_on_probe_closes_breaker():
+    completer, calls = make_completer([openai.error.ServiceUnavailableError("down"),
+                                       openai.error.InvalidRequestError("bad request", None)])
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        complete(completer)
+
+    # The probe reaches the primary model, which answers with an error that is not transient
+    with pytest.raises(openai.error.InvalidRequestError):
+        complete(completer)
+    assert completer.breaker.state == CircuitBreaker.CLOSED
+    assert completer.breaker.probing is False
+
+    # Later calls go to the primary model again
+    assert complete(completer) == ({"model": "primary"}, "primary")
+    assert calls == ["primary", "primary", "primary"]
+
+
+def test_cancelled_probe_frees_probe():
+    completer, _ = make_completer([openai.error.ServiceUnavailableError("down"), asyncio.CancelledError()])
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        complete(completer)
+    with pytest.raises(asyncio.CancelledError):
+        complete(completer)
+    assert completer.breaker.state == CircuitBreaker.HALF_OPEN
+    assert completer.breaker.probing is False
+    assert complete(completer) == ({"model": "primary"}, "primary")
@@ -0,0 +1,194 @@
+"""
+Tokens.py file for ProxyGPT. This file contains the local token counting and
+the choice of max_tokens for each completion.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for caching the counts of constant prompts and recent completion lengths
+from collections import OrderedDict, deque
+import logging
+import math
+
+from typing import List, Optional
+
+# Required for the fallback estimate when tiktoken is not available
+from knowledge import estimate_tokens
+
+# Optional: exact token counts with the tokenizer of the model
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# ------------- [Settings] -------------
+
+# Tokens the chat format adds per message, and to prime the reply (GPT-3.5 and GPT-4)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+logger = logging.getLogger("joycoach.tokens")
+
+
+# ------------- [Classes] -------------
+
+class TokenCounter:
+    """
+    Counts the prompt tokens of chat messages locally, before they are sent.
+
+    Uses the tokenizer of the model when tiktoken and its encoding files are
+    available, and the four characters per token estimate otherwise. The
+    parts the system prompt is built from, the fixed wrapper and each
+    knowledge chunk, are the same for many requests. Each part is counted
+    once and its count kept in a small LRU cache.
+    """
+
+    def __init__(self, model: str, max_cached: int = 256):
+        self.model = model
+        self.max_cached = max_cached
+        self._cached = OrderedDict()
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                # The encoding files are downloaded on first use, which can fail offline
+                logger.warning("Counting tokens with estimates, the tokenizer of %s could not be loaded: %r", model, e)
+
+    def count(self, text: str) -> int:
+        """
+        Returns the number of tokens in a text.
+        """
+        if self.encoding is None:
+            return estimate_tokens(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_cached(self, text: str) -> int:
+        """
+        Returns the number of tokens in a text that is likely to be counted
+        again, from the cache if it was counted before.
+        """
+        count = self._cached.get(text)
+        if count is not None:
+            self._cached.move_to_end(text)
+            return count
+        count = self.count(text)
+        self._cached[text] = count
+        if len(self._cached) > self.max_cached:
+            self._cached.popitem(last=False)
+        return count
+
+    def count_messages(self, messages: List[dict], system_parts: Optional[List[str]] = None) -> int:
+        """
+        Returns the number of prompt tokens of chat messages, as billed by
+        OpenAI. When system_parts, the texts the first system message was
+        joined from, are given, that message is counted as the sum of the
+        cached counts of its parts. The tokenizer can merge a few characters
+        across part boundaries, so the sum may differ from the exact count
+        by a token or two; the actual usage settles the difference.
+        """
+        total = TOKENS_PER_REPLY
+        for index, message in enumerate(messages):
+            if index == 0 and system_parts is not None and message["role"] == "system":
+                total += sum(self.count_cached(part) for part in system_parts)
+            else:
+                total += self.count(message["content"])
+            total += TOKENS_PER_MESSAGE
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "tokenizer": self.encoding.name if self.encoding is not None else "estimate",
+            "cached_prompts": len(self._cached),
+        }
+
+
+class CompletionPlan:
+    """
+    The messages of a completion with their counted prompt tokens and the
+    chosen max_tokens. The prompt and max_tokens are reserved against the
+    token budgets before the call, and settled with the actual usage after,
+    in the usage bucket the reservation was recorded in.
+    """
+
+    __slots__ = ("messages", "prompt_tokens", "max_tokens", "bucket")
+
+    def __init__(self, messages: List[dict], prompt_tokens: int, max_tokens: int, bucket: Optional[int] = None):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.bucket = bucket
+
+    @property
+    def reserved_tokens(self) -> int:
+        return self.prompt_tokens + self.max_tokens
+
+
+class MaxTokensPolicy:
+    """
+    Chooses max_tokens per completion from the lengths of recent completions.
+
+    Until min_samples completions have been seen, ceiling is used. After
+    that max_tokens is the percentile of recent completion lengths times
+    headroom, at least floor and at most ceiling. Completions cut off at
+    max_tokens are recorded longer than they were, so the choice grows back
+    quickly. When adaptive is False, ceiling is always used. max_tokens
+    never exceeds what is left of the context window after the prompt.
+    """
+
+    def __init__(self, ceiling: int, floor: int = 500, percentile: float = 0.99, headroom: float = 1.5,
+                 min_samples: int = 20, context_window: int = 8192, max_samples: int = 500,
+                 adaptive: bool = True):
+        self.ceiling = ceiling
+        self.floor = floor
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.context_window = context_window
+        self.adaptive = adaptive
+        self._lengths = deque(maxlen=max_samples)
+        self.truncated = 0
+
+    def record(self, completion_tokens: int, truncated: bool = False) -> None:
+        if truncated:
+            self.truncated += 1
+            completion_tokens = int(completion_tokens * self.headroom)
+        self._lengths.append(completion_tokens)
+
+    def _recent_percentile(self) -> Optional[int]:
+        if len(self._lengths) < self.min_samples:
+            return None
+        lengths = sorted(self._lengths)
+        return lengths[min(len(lengths) - 1, math.ceil(self.percentile * len(lengths)) - 1)]
+
+    def largest(self, prompt_tokens: int) -> int:
+        """
+        Returns the largest max_tokens allowed for a completion with
+        prompt_tokens prompt tokens: ceiling, or less if the context window
+        does not hold more.
+        """
+        return max(1, min(self.ceiling, self.context_window - prompt_tokens))
+
+    def choose(self, prompt_tokens: int) -> int:
+        """
+        Returns max_tokens for a completion with prompt_tokens prompt tokens.
+        """
+        recent = self._recent_percentile() if self.adaptive else None
+        if recent is None:
+            return self.largest(prompt_tokens)
+        return min(self.largest(prompt_tokens), max(self.floor, int(recent * self.headroom)))
+
+    def stats(self) -> dict:
+        lengths = sorted(self._lengths)
+        return {
+            "adaptive": self.adaptive,
+            "samples": len(lengths),
+            "average_completion_tokens": sum(lengths) / len(lengths) if lengths else None,
+            "recent_percentile_tokens": self._recent_percentile(),
+            "truncated": self.truncated,
+            "max_tokens": self.choose(0),
+        }
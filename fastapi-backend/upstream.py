@@ -0,0 +1,316 @@
+"""
+Upstream.py file for ProxyGPT. This file contains the asynchronous client
+used to call the OpenAI API.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the pooled, keep-alive HTTP session
+import aiohttp
+
+# Required for tracking the load and health of the pool members
+import time
+
+from typing import List, Optional
+
+# Import required libraries from OpenAI for API functionality
+import openai
+
+# Required for the upstream latency and error metrics
+from metrics import phase, UPSTREAM_ERRORS, UPSTREAM_MEMBER_CALLS
+
+# Import upstream client settings
+from settings import (
+    UPSTREAM_POOL_SIZE,
+    UPSTREAM_KEEPALIVE_TIMEOUT,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    POOL_EJECT_TIME,
+    POOL_MAX_EJECT_TIME,
+)
+
+
+# ------------- [Session] -------------
+
+# One shared session per worker process, created lazily inside the event loop
+_session = None
+
+
+class UpstreamSession:
+    """
+    Wraps the shared session for the OpenAI library. The library replaces the
+    timeout of the session with its own total timeout on every request, so
+    the read timeout is put back here. A stalled connection is then caught
+    after UPSTREAM_READ_TIMEOUT seconds without data, while the total time of
+    a call is left to the caller (the resilience deadline), so long streams
+    are not cut off.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    def request(self, method: str, url, timeout: Optional[aiohttp.ClientTimeout] = None, **kwargs):
+        timeout = aiohttp.ClientTimeout(
+            total=timeout.total if timeout is not None else None,
+            connect=timeout.connect if timeout is not None and timeout.connect else UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=UPSTREAM_READ_TIMEOUT,
+        )
+        return self.session.request(method, url, timeout=timeout, **kwargs)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    This function returns the shared aiohttp session of this worker,
+    creating it on first use. Connections are pooled and kept alive,
+    so consecutive completions skip the TCP and TLS handshakes.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=UPSTREAM_POOL_SIZE,
+            keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=UPSTREAM_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session() -> None:
+    """
+    This function closes the shared session. It is called on worker shutdown.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+# ------------- [Credential Pool] -------------
+
+class PoolMember:
+    """
+    One OpenAI credential of the upstream pool: an API key, an optional base
+    URL (None uses openai.api_base) and a capacity weight.
+    """
+
+    # Weight of the newest sample in the moving average of the latency
+    LATENCY_WEIGHT = 0.1
+
+    def __init__(self, name: str, api_key: str, api_base: Optional[str] = None, weight: float = 1):
+        self.name = name
+        self.api_key = api_key
+        self.api_base = api_base
+        self.weight = weight
+        self.inflight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+        self.consecutive_throttles = 0
+        self.ejected_until = 0.0
+        self.average_latency = None
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def eject(self, seconds: float) -> None:
+        self.ejected_until = max(self.ejected_until, time.monotonic() + seconds)
+
+    def record_success(self, latency: float) -> None:
+        self.consecutive_throttles = 0
+        if self.average_latency is None:
+            self.average_latency = latency
+        else:
+            self.average_latency += self.LATENCY_WEIGHT * (latency - self.average_latency)
+        UPSTREAM_MEMBER_CALLS.labels(self.name, "success").inc()
+
+    def record_error(self, e: Exception) -> None:
+        if isinstance(e, openai.error.RateLimitError):
+            # Eject for as long as OpenAI asks, or for longer after every 429 in a row
+            self.throttled += 1
+            self.consecutive_throttles += 1
+            try:
+                seconds = float(e.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                seconds = POOL_EJECT_TIME * 2 ** (self.consecutive_throttles - 1)
+            self.eject(min(seconds, POOL_MAX_EJECT_TIME))
+            UPSTREAM_MEMBER_CALLS.labels(self.name, "throttled").inc()
+        elif isinstance(e, (openai.error.AuthenticationError, openai.error.PermissionError)):
+            # A revoked key will not work again soon
+            self.errors += 1
+            self.eject(POOL_MAX_EJECT_TIME)
+            UPSTREAM_MEMBER_CALLS.labels(self.name, "error").inc()
+        else:
+            self.errors += 1
+            UPSTREAM_MEMBER_CALLS.labels(self.name, "error").inc()
+
+    def stats(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "api_key": f"{self.api_key[:3]}...{self.api_key[-4:]}",
+            "api_base": self.api_base or openai.api_base,
+            "weight": self.weight,
+            "inflight": self.inflight,
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "ejected_for": max(0.0, self.ejected_until - now),
+            "average_latency": self.average_latency,
+        }
+
+
+class UpstreamPool:
+    """
+    Spreads the OpenAI calls of a worker over several credentials.
+
+    Each call goes to the member with the fewest calls in flight per unit of
+    weight, and ties go to the member with the fewest calls so far per unit of
+    weight, so under light load the members take turns in proportion to their
+    weights. Members that are throttled (429) or whose key is rejected are
+    ejected for a while. If all members are ejected, the one that comes back
+    first is used.
+    """
+
+    def __init__(self, members: List[PoolMember]):
+        if not members:
+            raise ValueError("The upstream pool needs at least one member.")
+        self.members = members
+
+    def select(self) -> PoolMember:
+        now = time.monotonic()
+        available = [member for member in self.members if not member.is_ejected(now)]
+        if not available:
+            return min(self.members, key=lambda member: member.ejected_until)
+        return min(available, key=lambda member: (member.inflight / member.weight, member.calls / member.weight))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        members = [member.stats(now) for member in self.members]
+        return {
+            "members": members,
+            "available": sum(1 for member in self.members if not member.is_ejected(now)),
+        }
+
+
+# Make function for parsing the pool configuration
+def parse_pool_spec(spec: str) -> List[dict]:
+    """
+    This function parses the OPENAI_API_POOL environment variable: comma
+    separated members of the form api_key|api_base|weight, where api_base and
+    weight may be left out or empty.
+
+    Returns:
+        list: One dict per member with the api_key, api_base and weight as strings or None.
+    """
+    members = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        parts = [part.strip() for part in entry.split("|")] + ["", ""]
+        members.append({
+            "api_key": parts[0],
+            "api_base": parts[1] or None,
+            "weight": parts[2] or None,
+        })
+    return members
+
+
+# The pool of this worker, None to use openai.api_key for every call
+_pool = None
+
+
+def configure_pool(pool: Optional[UpstreamPool]) -> None:
+    """
+    This function sets the credential pool used by create_chat_completion.
+    """
+    global _pool
+    _pool = pool
+
+
+def get_pool() -> Optional[UpstreamPool]:
+    return _pool
+
+
+# ------------- [Completions] -------------
+
+async def create_chat_completion(**kwargs):
+    """
+    This function creates a chat completion without blocking the event loop.
+    All keyword arguments are passed through to openai.ChatCompletion.acreate.
+
+    Returns:
+        The OpenAI completion response.
+    """
+    # The OpenAI library reads the session from a context variable, so it is
+    # set in the context of the calling task before every request.
+    openai.aiosession.set(UpstreamSession(get_session()))
+    # No total timeout by default: the read timeout catches stalled connections,
+    # and callers that need one (the resilience deadline) pass their own
+    kwargs.setdefault("request_timeout", (UPSTREAM_CONNECT_TIMEOUT, None))
+    member = None
+    if _pool is not None:
+        member = _pool.select()
+        kwargs["api_key"] = member.api_key
+        if member.api_base:
+            kwargs["api_base"] = member.api_base
+        member.inflight += 1
+        member.calls += 1
+    # For streamed completions this measures the time until the stream opens
+    start = time.monotonic()
+    try:
+        with phase("upstream"):
+            try:
+                response = await openai.ChatCompletion.acreate(**kwargs)
+            except Exception as e:
+                UPSTREAM_ERRORS.labels(type(e).__name__).inc()
+                if member is not None:
+                    member.record_error(e)
+                raise
+    except BaseException:
+        if member is not None:
+            member.inflight -= 1
+        raise
+    if member is None:
+        return response
+    member.record_success(time.monotonic() - start)
+    if kwargs.get("stream"):
+        # The member stays loaded until the stream is consumed or closed
+        return PooledStream(response, member)
+    member.inflight -= 1
+    return response
+
+
+class PooledStream:
+    """
+    A streamed completion that keeps its pool member loaded until the stream
+    is consumed or closed.
+    """
+
+    def __init__(self, response, member: PoolMember):
+        self._response = response
+        self._member = member
+        self._released = False
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._member.inflight -= 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._response.__anext__()
+        except StopAsyncIteration:
+            self._release()
+            raise
+
+    async def aclose(self) -> None:
+        self._release()
+        await self._response.aclose()
@@ -0,0 +1,257 @@
+"""
+Webhook.py file for ProxyGPT. This file contains the background dispatcher
+that sends the Discord notifications off the response path.
+
+Version: 0.1.0-beta
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the background task and the persistent HTTP session
+import asyncio
+import aiohttp
+
+# Required for spilling notifications to disk
+import json
+import logging
+import os
+import time
+
+from typing import List, Optional
+
+# Required for the webhook latency and notification metrics
+from metrics import phase, WEBHOOK_NOTIFICATIONS
+
+
+# ------------- [Settings] -------------
+
+# Limits of a Discord message: embeds per message, characters per embed description and in total
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_DESCRIPTION = 4096
+DISCORD_MAX_TOTAL_CHARS = 6000
+
+logger = logging.getLogger("joycoach.webhook")
+
+
+# ------------- [Classes] -------------
+
+class WebhookDispatcher:
+    """
+    Sends Discord notifications from a background task.
+
+    Notifications are put on a bounded in-memory queue and never block the
+    caller. The task takes everything that arrived within flush_interval and
+    posts it as embeds of as few messages as Discord allows, over one
+    persistent HTTP session. It waits out Discord's rate limits using the
+    rate limit headers, and retries failed posts with exponential backoff.
+    When the queue is full, or a post keeps failing, notifications are
+    appended to spill_path (or dropped if it is None). Spilled notifications
+    are sent again on the next start.
+    """
+
+    def __init__(self, url: str, max_queue: int = 1000, flush_interval: float = 2.0,
+                 max_retries: int = 5, spill_path: Optional[str] = None):
+        self.url = url
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self._queue = None
+        self._session = None
+        self._task = None
+        # Time before which no post is sent, from Discord's rate limit headers
+        self._blocked_until = 0.0
+
+    def notify(self, username: str, content: str) -> None:
+        """
+        Queues a notification without waiting. Must be called from the event loop.
+        """
+        notification = {"username": username, "content": content}
+        if self._queue is None:
+            self._spill([notification])
+            return
+        try:
+            self._queue.put_nowait(notification)
+            WEBHOOK_NOTIFICATIONS.labels("queued").inc()
+        except asyncio.QueueFull:
+            self._spill([notification])
+
+    async def start(self) -> None:
+        """
+        Starts the background task, and queues notifications spilled by an earlier run.
+        """
+        self._queue = asyncio.Queue(self.max_queue)
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        for notification in self._load_spilled():
+            self.notify(notification["username"], notification["content"])
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10) -> None:
+        """
+        Sends the queued notifications within timeout seconds, spills the
+        rest to disk, and closes the session.
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        remaining = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        self._spill(remaining)
+        await self._session.close()
+        self._task = None
+        self._queue = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = []
+            payloads = None
+            try:
+                batch.append(await self._queue.get())
+                # Wait a little for more notifications, so they are sent together
+                deadline = asyncio.get_running_loop().time() + self.flush_interval
+                while True:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                payloads = self._build_payloads(batch)
+                while payloads:
+                    payload, notifications = payloads[0]
+                    if await self._post(payload):
+                        WEBHOOK_NOTIFICATIONS.labels("sent").inc(len(notifications))
+                    else:
+                        self._spill(notifications)
+                    payloads.pop(0)
+            except asyncio.CancelledError:
+                # Stopped on shutdown while collecting or posting, so keep what was not sent yet
+                self._spill(self._unsent(batch, payloads))
+                raise
+            except Exception:
+                # One bad batch must not stop the dispatcher for the rest of the worker's life
+                logger.exception("Discord webhook dispatcher failed to send a batch")
+                self._spill(self._unsent(batch, payloads))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _unsent(self, batch: List[dict], payloads: Optional[list]) -> List[dict]:
+        # The notifications of the batch that were not sent yet
+        if payloads is None:
+            return batch
+        return [n for _, notifications in payloads for n in notifications]
+
+    def _build_payloads(self, batch: List[dict]) -> list:
+        # Group notifications by username into messages within Discord's embed limits
+        payloads = []
+        current = None
+        for notification in batch:
+            description = notification["content"]
+            if len(description) > DISCORD_MAX_DESCRIPTION:
+                description = description[:DISCORD_MAX_DESCRIPTION - 1] + "…"
+            if (current is None or current[0]["username"] != notification["username"]
+                    or len(current[0]["embeds"]) >= DISCORD_MAX_EMBEDS
+                    or current[2] + len(description) > DISCORD_MAX_TOTAL_CHARS):
+                current = [{"username": notification["username"], "embeds": []}, [], 0]
+                payloads.append(current)
+            current[0]["embeds"].append({"description": description})
+            current[1].append(notification)
+            current[2] += len(description)
+        return [(payload, notifications) for payload, notifications, _ in payloads]
+
+    async def _post(self, payload: dict) -> bool:
+        # Post one message, waiting out rate limits and retrying failures with backoff
+        for attempt in range(self.max_retries + 1):
+            wait = self._blocked_until - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                with phase("webhook"):
+                    async with self._session.post(self.url, json=payload) as response:
+                        self._read_rate_limit(response.headers)
+                        if response.status == 429:
+                            retry_after = await self._read_retry_after(response)
+                            self._blocked_until = max(self._blocked_until, time.time() + retry_after)
+                            continue
+                        if response.status < 500:
+                            if response.status >= 400:
+                                # Client errors will not succeed on retry
+                                logger.error("Discord webhook rejected a notification with status %s", response.status)
+                                WEBHOOK_NOTIFICATIONS.labels("rejected").inc(len(payload["embeds"]))
+                            return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Discord webhook failed: %r", e)
+            await asyncio.sleep(min(2 ** attempt, 30))
+        return False
+
+    async def _read_retry_after(self, response: aiohttp.ClientResponse) -> float:
+        # Seconds to wait after a 429, from the JSON body, else the Retry-After header, else one second
+        try:
+            body = await response.json(content_type=None)
+            return float(body["retry_after"])
+        except (ValueError, TypeError, KeyError, aiohttp.ClientError):
+            pass
+        try:
+            return float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            return 1.0
+
+    def _read_rate_limit(self, headers) -> None:
+        # When the bucket is empty, hold the next post until it resets
+        if headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset-After" in headers:
+            try:
+                self._blocked_until = max(self._blocked_until, time.time() + float(headers["X-RateLimit-Reset-After"]))
+            except ValueError:
+                pass
+
+    def _spill(self, notifications: List[dict]) -> None:
+        if not notifications:
+            return
+        if not self.spill_path:
+            WEBHOOK_NOTIFICATIONS.labels("dropped").inc(len(notifications))
+            return
+        with open(self.spill_path, "a") as f:
+            for notification in notifications:
+                f.write(json.dumps(notification) + "\n")
+        WEBHOOK_NOTIFICATIONS.labels("spilled").inc(len(notifications))
+
+    def _load_spilled(self) -> List[dict]:
+        # Take over the spill file, so notifications are not sent twice by several workers
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        claimed = f"{self.spill_path}.{os.getpid()}"
+        try:
+            os.rename(self.spill_path, claimed)
+        except OSError:
+            return []
+        notifications = []
+        try:
+            with open(claimed, errors="replace") as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    # A worker killed while appending can leave a truncated line
+                    try:
+                        notification = json.loads(line)
+                    except json.JSONDecodeError:
+                        notification = None
+                    if not isinstance(notification, dict) or "username" not in notification or "content" not in notification:
+                        logger.warning("Skipped unreadable line %d of the Discord webhook spill file", number)
+                        continue
+                    notifications.append(notification)
+        finally:
+            # The claimed file is never left behind, since no other worker would read it
+            os.remove(claimed)
+        return notifications